@@ -1,71 +1,288 @@
 import random
 from types import SimpleNamespace
 import asyncio
-from openai import AsyncOpenAI
+import logging
 import os
+import time
+from log_config import LOG_STREAM_CHUNKS, current_request_id, new_request_id
+from openai_client import get_client
+from context_window import build_messages, estimate_tokens
+import response_cache
+import jokes
+import singleflight
+import resilience
+import metrics
+
+MODEL = "gpt-3.5-turbo"
+JOKEBOT_INSTRUCTIONS = "You are JokeBot, a humorous chatbot. Respond playfully and include a joke if appropriate."
+logger = logging.getLogger(__name__)
+
+UPSTREAM_TTFT_SECONDS = metrics.histogram(
+    "jokebot_upstream_ttft_seconds", "Time from starting the upstream call to its first token", ["model"])
+UPSTREAM_STREAM_SECONDS = metrics.histogram(
+    "jokebot_upstream_stream_seconds", "Total upstream stream duration", ["model"])
+REPLY_CHUNKS = metrics.histogram(
+    "jokebot_reply_chunks", "Chunks per upstream reply", ["model"], buckets=metrics.SIZE_BUCKETS)
+REPLY_CHARS = metrics.histogram(
+    "jokebot_reply_chars", "Characters per upstream reply", ["model"], buckets=metrics.SIZE_BUCKETS)
+REPLIES = metrics.counter("jokebot_replies_total", "Replies by where they came from", ["source"])
+
+FALLBACK_MESSAGE = "Sorry, I couldn't generate a response. Here's a joke instead: Why did the tomato turn red? It saw the salad dressing! 😎"
+
+class ModelRouter:
+    """Pick a model per request: `fast_model` for short prompts early in a
+    conversation, `strong_model` for everything else.
+
+    A prompt counts as short when it is at most `short_prompt_tokens` and the
+    conversation has at most `short_history_turns` prior messages.
+    """
+    def __init__(self, fast_model, strong_model, short_prompt_tokens=40, short_history_turns=6,
+                 fast_max_tokens=None):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.short_prompt_tokens = short_prompt_tokens
+        self.short_history_turns = short_history_turns
+        self.fast_max_tokens = fast_max_tokens
+
+    @classmethod
+    def from_env(cls):
+        """Router configured by MODEL_ROUTER_* settings, or None when MODEL_ROUTER is not "1".
+
+        Defaults to gpt-4o-mini for short prompts and gpt-4o for the rest.
+        """
+        if os.getenv("MODEL_ROUTER", "0") != "1":
+            return None
+        fast_max_tokens = os.getenv("MODEL_ROUTER_FAST_MAX_TOKENS")
+        return cls(
+            fast_model=os.getenv("MODEL_ROUTER_FAST_MODEL", "gpt-4o-mini"),
+            strong_model=os.getenv("MODEL_ROUTER_STRONG_MODEL", "gpt-4o"),
+            short_prompt_tokens=int(os.getenv("MODEL_ROUTER_SHORT_PROMPT_TOKENS", "40")),
+            short_history_turns=int(os.getenv("MODEL_ROUTER_SHORT_HISTORY_TURNS", "6")),
+            fast_max_tokens=int(fast_max_tokens) if fast_max_tokens else None,
+        )
+
+    def route(self, input, history):
+        """Return overrides for this request: {"model": ...} and optionally "max_tokens"."""
+        short = (estimate_tokens(input) <= self.short_prompt_tokens
+                 and len(history or []) <= self.short_history_turns)
+        if not short:
+            return {"model": self.strong_model}
+        route = {"model": self.fast_model}
+        if self.fast_max_tokens:
+            route["max_tokens"] = self.fast_max_tokens
+        return route
 
 class Agent:
-    def __init__(self, name, instructions, tools=None):
+    def __init__(self, name, instructions, tools=None, model=MODEL, temperature=None, max_tokens=None,
+                 router=None):
         self.name = name
         self.instructions = instructions
         self.tools = tools or []
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.router = router
+
+    def model_settings(self, input, history=None):
+        """Model and sampling parameters for one request, after routing."""
+        settings = {"model": self.model, "temperature": self.temperature, "max_tokens": self.max_tokens}
+        if self.router is not None:
+            settings.update(self.router.route(input, history))
+        return settings
+
+class FlushPolicy:
+    """How streamed text is coalesced before it is yielded as a UI event.
+
+    Buffered text is flushed once `interval` seconds have passed since the last
+    flush or once `max_chars` characters are waiting, whichever comes first.
+    The first chunk is always flushed immediately so time-to-first-token is
+    unaffected. With both limits at 0 every chunk is passed straight through.
+    """
+    def __init__(self, interval=0.04, max_chars=64):
+        self.interval = interval
+        self.max_chars = max_chars
+
+    @property
+    def passthrough(self):
+        return not self.interval and not self.max_chars
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            interval=float(os.getenv("STREAM_FLUSH_MS", "40")) / 1000,
+            max_chars=int(os.getenv("STREAM_FLUSH_CHARS", "64")),
+        )
+
+    @classmethod
+    def none(cls):
+        return cls(interval=0, max_chars=0)
+
+async def coalesce(chunks, policy):
+    """Re-chunk an async iterator of strings according to a FlushPolicy."""
+    if policy.passthrough:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    iterator = chunks.__aiter__()
+    buffer = []
+    buffered = 0
+    first = True
+    last_flush = time.monotonic()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if buffer and policy.interval:
+                timeout = max(0, policy.interval - (time.monotonic() - last_flush))
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                try:
+                    chunk = pending.result()
+                except StopAsyncIteration:
+                    pending = None
+                    break
+                pending = None
+                buffer.append(chunk)
+                buffered += len(chunk)
+            due = policy.interval and time.monotonic() - last_flush >= policy.interval
+            full = policy.max_chars and buffered >= policy.max_chars
+            if buffer and (first or due or full):
+                yield "".join(buffer)
+                buffer.clear()
+                buffered = 0
+                first = False
+                last_flush = time.monotonic()
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+def _text_event(text):
+    return SimpleNamespace(
+        type="run_item_stream_event",
+        item=SimpleNamespace(
+            type="message_output_item",
+            text=text
+        )
+    )
 
 class Runner:
     @staticmethod
-    def run_streamed(agent, input, name):
-        async def stream_events():
-            from asyncio import sleep
+    def run_streamed(agent, input, name, flush_policy=None, history=None, conversation_id=None, request_id=None):
+        """Stream a reply to `input`.
+
+        `history` is the prior conversation (dicts with role/content); it is
+        trimmed to CONTEXT_TOKEN_BUDGET, with older turns summarized and the
+        summary cached under `conversation_id`. `request_id` tags the log
+        records of this reply (defaults to the caller's request context).
+        """
+        policy = flush_policy or FlushPolicy.from_env()
+        settings = agent.model_settings(input, history)
+        # The stream runs on the shared event loop thread, so the request ID is
+        # passed explicitly rather than read from the caller's context.
+        log = {"request_id": request_id or current_request_id() or new_request_id()}
+
+        async def stream_text():
+            # Common mood prompts are answered from the local corpus, no API call.
+            local = jokes.local_reply(input, name)
+            if local:
+                REPLIES.inc(source="local")
+                yield local
+                return
+
             api_key = os.getenv("OPENAI_API_KEY")
             if not api_key:
-                print("❌ Open AI API key not set")
+                logger.error("OpenAI API key not set", extra=log)
                 # Fallback response
-                yield SimpleNamespace(
-                    type="run_item_stream_event",
-                    item=SimpleNamespace(
-                        type="message_output_item",
-                        text="Error: Open AI API key not configured."
-                    )
-                )
+                yield "Error: Open AI API key not configured."
                 return
 
-            client = AsyncOpenAI(api_key=api_key)
-            print(f"Calling Open AI API with input: {input}")
-            try:
+            # Requests with the same key are interchangeable: they can share a
+            # cached reply or one in-flight upstream completion.
+            shareable = response_cache.cacheable(history)
+            cache = response_cache.get_cache() if shareable else None
+            key = response_cache.cache_key(
+                settings["model"], input, name=name, instructions=agent.instructions,
+                temperature=settings["temperature"], max_tokens=settings["max_tokens"])
+            if cache is not None:
+                cached = cache.get(key)
+                if cached:
+                    logger.info("Serving cached reply", extra=log)
+                    REPLIES.inc(source="cache")
+                    yield cached
+                    return
+
+            if shareable and singleflight.SINGLEFLIGHT:
+                source = singleflight.group.stream(key, lambda: upstream(api_key, cache, key))
+            else:
+                source = upstream(api_key, cache, key)
+            async for content in source:
+                yield content
+
+        async def upstream(api_key, cache, key):
+            client = get_client(api_key)
+            logger.info("Calling OpenAI model=%s input_chars=%d history=%d", settings["model"], len(input),
+                        len(history or []), extra=log)
+            parts = []
+            system_prompt = f"{agent.instructions} Personalize replies with the user's name: {name}."
+            messages = build_messages(system_prompt, history, input, conversation_id)
+            params = {k: v for k, v in settings.items() if v is not None}
+            model = settings["model"]
+            started = time.perf_counter()
+
+            async def open_stream():
                 stream = await client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": f"You are JokeBot, a humorous chatbot. Respond playfully and include a joke if appropriate. Personalize replies with the user's name: {name}."},
-                        {"role": "user", "content": input}
-                    ],
-                    stream=True
+                    messages=messages,
+                    stream=True,
+                    **params
                 )
-                async for chunk in stream:
-                    content = chunk.choices[0].delta.content or ""
-                    if content:
-                        print(f"Streaming chunk: {content}")
-                        yield SimpleNamespace(
-                            type="run_item_stream_event",
-                            item=SimpleNamespace(
-                                type="message_output_item",
-                                text=content
-                            )
-                        )
-                        await sleep(0.1)  # Maintain streaming effect
+
+                async def texts():
+                    try:
+                        async for chunk in stream:
+                            content = chunk.choices[0].delta.content if chunk.choices else None
+                            if content:
+                                yield content
+                    finally:
+                        await stream.close()
+                return texts()
+
+            try:
+                async for content in resilience.resilient_stream(open_stream):
+                    if LOG_STREAM_CHUNKS:
+                        logger.debug("Stream chunk %d chars=%d", len(parts), len(content), extra=log)
+                    if not parts:
+                        UPSTREAM_TTFT_SECONDS.observe(time.perf_counter() - started, model=model)
+                    parts.append(content)
+                    yield content
+            except resilience.CircuitOpen:
+                logger.warning("OpenAI circuit open, serving fallback", extra=log)
+                REPLIES.inc(source="circuit_open")
+                yield FALLBACK_MESSAGE
+                return
             except Exception as e:
-                print(f"Open AI API error: {str(e)}")
-                error_msg = "Sorry, I couldn't generate a response. Here's a joke instead: Why did the tomato turn red? It saw the salad dressing! 😎"
-                for word in error_msg.split():
-                    yield SimpleNamespace(
-                        type="run_item_stream_event",
-                        item=SimpleNamespace(
-                            type="message_output_item",
-                            text=word + " "
-                        )
-                    )
-                    await sleep(0.1)
+                logger.error("OpenAI API error: %s", e, extra=log)
+                REPLIES.inc(source="error")
+                yield FALLBACK_MESSAGE
+                return
+            UPSTREAM_STREAM_SECONDS.observe(time.perf_counter() - started, model=model)
+            REPLY_CHUNKS.observe(len(parts), model=model)
+            REPLY_CHARS.observe(sum(len(p) for p in parts), model=model)
+            REPLIES.inc(source="upstream")
+            logger.info("OpenAI reply complete chunks=%d", len(parts), extra=log)
+            if cache is not None and parts:
+                cache.put(key, "".join(parts))
+
+        async def stream_events():
+            async for text in coalesce(stream_text(), policy):
+                yield _text_event(text)
         return SimpleNamespace(stream_events=stream_events)
 
 class ItemHelpers:
     @staticmethod
     def text_message_output(item):
-        return getattr(item, "text", "")
\ No newline at end of file
+        return getattr(item, "text", "")
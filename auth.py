@@ -1,5 +1,8 @@
+import sqlite3
 import streamlit as st
 from db import register_user, authenticate_user
+from hashing import HashingBusy
+import rate_limit
 from password_reset import reset_password_ui
 
 # ─── Custom Styling ───
@@ -98,7 +101,14 @@ def login_form():
         login_clicked = col1.form_submit_button("Login")
 
         if login_clicked:
-            user = authenticate_user(email, password)
+            if not rate_limit.allow("login", email, st.session_state):
+                st.error("🚦 Too many attempts. Please wait a moment and try again.")
+                return
+            try:
+                user = authenticate_user(email, password)
+            except HashingBusy:
+                st.warning("⏳ Server is busy, please try again in a moment.")
+                return
             if user:
                 st.session_state.user = user
                 st.success("🎉 Login successful!")
@@ -121,13 +131,20 @@ def signup_form():
         password = st.text_input("🔑 Password", type="password")
 
         if st.form_submit_button("Sign Up"):
+            if not rate_limit.allow("signup", email, st.session_state):
+                st.error("🚦 Too many attempts. Please wait a moment and try again.")
+                return
             try:
                 register_user(email, name, password)
                 st.session_state.user = {"email": email, "name": name}
                 st.success("🎉 Registered and logged in!")
                 st.rerun()
-            except Exception:
+            except HashingBusy:
+                st.warning("⏳ Server is busy, please try again in a moment.")
+            except sqlite3.IntegrityError:
                 st.error("⚠️ Email already exists.")
+            except Exception:
+                st.error("⚠️ Registration failed. Please try again.")
 
 
 # ─── Main Auth UI ───
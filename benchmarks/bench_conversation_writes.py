@@ -0,0 +1,54 @@
+# benchmarks/bench_conversation_writes.py
+"""Per-turn save cost of full-rewrite JSON versus append-only JSON Lines.
+
+Usage: python benchmarks/bench_conversation_writes.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conversation_store  # noqa: E402
+
+SIZES = [10, 1_000, 10_000]
+TURNS = 20
+
+
+def make_messages(n):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant",
+         "content": f"message {i} " + "ha" * 40,
+         "timestamp": "2025-01-01 00:00:00"}
+        for i in range(n)
+    ]
+
+
+def bench(fmt, size):
+    conversation_store.STORAGE_FORMAT = fmt
+    email = f"bench-{fmt}-{size}@example.com"
+    conv_id = "chat_bench_1"
+    entry = conversation_store.add_conversation(email, conv_id)
+    messages = make_messages(size)
+    conversation_store.save_conversation(email, conv_id, entry["file"], messages)
+
+    start = time.perf_counter()
+    for i in range(TURNS):
+        messages.append({"role": "user", "content": f"turn {i}", "timestamp": "2025-01-01 00:00:01"})
+        conversation_store.save_conversation(email, conv_id, entry["file"], messages)
+    return (time.perf_counter() - start) / TURNS
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        conversation_store.USER_DATA_DIR = tmp
+        print(f"{'messages':>10} {'json ms/turn':>14} {'jsonl ms/turn':>14}")
+        for size in SIZES:
+            json_cost = bench("json", size)
+            jsonl_cost = bench("jsonl", size)
+            print(f"{size:>10} {json_cost * 1000:>14.3f} {jsonl_cost * 1000:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# benchmarks/bench_db_concurrency.py
+"""Concurrent login/registration throughput against users.db.
+
+Compares the old connect-per-call access pattern with the pooled WAL
+connections in db.py at 1, 8 and 32 threads. Passwords are hashed once with
+a low bcrypt cost up front so the numbers reflect database access, not
+hashing.
+
+Usage: python benchmarks/bench_db_concurrency.py [--ops 2000]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bcrypt import checkpw, gensalt, hashpw  # noqa: E402
+
+import db  # noqa: E402
+
+THREAD_COUNTS = [1, 8, 32]
+PASSWORD = b"hunter2"
+CHEAP_HASH = hashpw(PASSWORD, gensalt(4))
+
+
+def legacy_register(email, name, password_hash):
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.execute("INSERT INTO users (email, name, password_hash) VALUES (?, ?, ?)",
+                 (email, name, password_hash))
+    conn.commit()
+    conn.close()
+
+
+def legacy_init():
+    # The pre-pool schema in a rollback-journal database; db.init_db() would
+    # switch the file to WAL and hide the difference being measured.
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, name TEXT, password_hash TEXT)")
+    conn.commit()
+    conn.close()
+
+
+def legacy_login(email):
+    conn = sqlite3.connect(db.DB_PATH)
+    row = conn.execute("SELECT name, password_hash FROM users WHERE email=?", (email,)).fetchone()
+    conn.close()
+    return row and checkpw(PASSWORD, row[1])
+
+
+def pooled_login(email):
+    row = db.query_one("SELECT name, password_hash FROM users WHERE email=?", (email,))
+    return row and checkpw(PASSWORD, row[1])
+
+
+def run(label, register, login, threads, ops):
+    counter = iter(range(ops))
+    lock = threading.Lock()
+    errors = [0]
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            try:
+                if i % 5 == 0:
+                    register(f"{label}-{threads}-{i}@example.com", "Bench", CHEAP_HASH)
+                else:
+                    login("seed@example.com")
+            except sqlite3.OperationalError:
+                errors[0] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        for _ in range(threads):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<8} {threads:>7} {ops / elapsed:>12.0f} {errors[0]:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ops", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'mode':<8} {'threads':>7} {'ops/sec':>12} {'errors':>7}")
+        for label, init, register, login in (("legacy", legacy_init, legacy_register, legacy_login),
+                                             ("pooled", db.init_db, db.insert_user, pooled_login)):
+            db.DB_PATH = os.path.join(tmp, f"{label}.db")
+            init()
+            register("seed@example.com", "Seed", CHEAP_HASH)
+            for threads in THREAD_COUNTS:
+                run(label, register, login, threads, args.ops)
+        db.get_pool().close()
+
+
+if __name__ == "__main__":
+    main()
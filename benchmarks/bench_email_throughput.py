@@ -0,0 +1,60 @@
+# benchmarks/bench_email_throughput.py
+"""OTP email throughput: one request per message vs batched bulk submission.
+
+Drains an outbox of N queued OTPs against the local fake MailerSend server
+with a fixed per-request latency, and reports messages/sec and HTTP requests
+made in each mode.
+
+Usage: python benchmarks/bench_email_throughput.py [--messages 1000] [--latency-ms 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import otp_sender  # noqa: E402
+from fake_mailersend import start_server  # noqa: E402
+
+
+def run(mode, messages, latency_ms, tmp):
+    server, base_url = start_server(latency_ms=latency_ms)
+    db.DB_PATH = os.path.join(tmp, f"{mode}.db")
+    db.init_db()
+    otp_sender.API_KEY = "bench"
+    otp_sender.SENDER_EMAIL = "bench@example.com"
+    otp_sender.MAILER_SEND_URL = f"{base_url}/email"
+    otp_sender.MAILER_SEND_BULK_URL = f"{base_url}/bulk-email"
+    otp_sender.OUTBOX_MODE = mode
+    otp_sender.BULK_WINDOW = 0
+
+    for i in range(messages):
+        otp_sender.enqueue_email(f"user{i}@example.com", "🔐 Your OTP Code", f"Your OTP is: {i:06d}")
+
+    start = time.perf_counter()
+    while db.query_one("SELECT COUNT(*) FROM email_outbox WHERE status IN (?, ?)",
+                       (otp_sender.SENT, otp_sender.FAILED))[0] < messages:
+        otp_sender.drain_once()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    print(f"{mode:<7} {messages:>9} {messages / elapsed:>12.0f} {server.stats['requests']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'mode':<7} {'messages':>9} {'msgs/sec':>12} {'requests':>9}")
+        for mode in ("single", "bulk"):
+            run(mode, args.messages, args.latency_ms, tmp)
+        db.get_pool().close()
+
+
+if __name__ == "__main__":
+    main()
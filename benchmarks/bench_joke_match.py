@@ -0,0 +1,49 @@
+# benchmarks/bench_joke_match.py
+"""Throughput of the local mood/joke matcher over a large input set.
+
+Usage: python benchmarks/bench_joke_match.py [--inputs 200000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jokes  # noqa: E402
+
+MOOD_INPUTS = ["I'm sad", "so bored", "i am really tired", "tell me a joke", "feeling blue today",
+               "im stressed", "make me laugh", "I'm not sad", "lonely"]
+OTHER_INPUTS = ["what's the weather like in Paris tomorrow?", "write me a poem about cats",
+                "can you explain how rainbows form", "my boss is tired of my excuses, help me write an email",
+                "hello there", "what is 2 + 2"]
+
+
+def make_inputs(n, rng):
+    return [rng.choice(MOOD_INPUTS if rng.random() < 0.5 else OTHER_INPUTS) for _ in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--inputs", type=int, default=200_000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = jokes.get_index()
+    load_ms = (time.perf_counter() - start) * 1000
+
+    inputs = make_inputs(args.inputs, random.Random(0))
+    start = time.perf_counter()
+    matched = sum(1 for text in inputs if index.match(text))
+    elapsed = time.perf_counter() - start
+
+    print(f"index load      {load_ms:10.2f} ms")
+    print(f"inputs          {len(inputs):10d}")
+    print(f"matched         {matched:10d}")
+    print(f"throughput      {len(inputs) / elapsed:10.0f} inputs/sec")
+    print(f"mean per input  {elapsed / len(inputs) * 1e6:10.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# benchmarks/bench_transcript.py
+"""Open and rerun cost of the chat transcript for long conversations.
+
+"full" is the old behaviour: json-load every message when a conversation is
+opened, then sort and render all of them on every rerun. "windowed" reads
+the last HISTORY_TAIL messages with read_window and renders the last
+TRANSCRIPT_WINDOW. Streamlit calls are replaced by a fake that serializes
+each markdown payload, which is what a rerun sends to the frontend.
+
+Usage: python benchmarks/bench_transcript.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import conversation_store  # noqa: E402
+
+SIZES = [100, 1_000, 10_000]
+RERUNS = 20
+HISTORY_TAIL = 200
+TRANSCRIPT_WINDOW = 40
+
+
+def make_messages(n):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant",
+         "content": f"message {i} " + "ha" * 40,
+         "timestamp": f"2025-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}"}
+        for i in range(n)
+    ]
+
+
+def render(messages):
+    """Stand-in for one st.chat_message + st.markdown per message; returns bytes sent."""
+    sent = 0
+    for msg in messages:
+        sent += len(json.dumps({"role": msg["role"], "body": msg["content"]}).encode("utf-8"))
+    return sent
+
+
+def full(file_path):
+    start = time.perf_counter()
+    messages = conversation_store.read_messages(file_path)
+    opened = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(RERUNS):
+        sent = render(sorted(messages, key=lambda x: x.get("timestamp", "")))
+    return opened, (time.perf_counter() - start) / RERUNS, sent
+
+
+def windowed(file_path):
+    start = time.perf_counter()
+    _, messages = conversation_store.read_window(file_path, HISTORY_TAIL)
+    opened = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(RERUNS):
+        sent = render(messages[-TRANSCRIPT_WINDOW:])
+    return opened, (time.perf_counter() - start) / RERUNS, sent
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'messages':>10} {'mode':>9} {'open ms':>9} {'rerun ms':>9} {'KB/rerun':>9}")
+        for size in SIZES:
+            file_path = os.path.join(tmp, f"chat_{size}.jsonl")
+            conversation_store.write_messages(file_path, make_messages(size))
+            for mode, fn in (("full", full), ("windowed", windowed)):
+                opened, rerun, sent = fn(file_path)
+                print(f"{size:>10} {mode:>9} {opened * 1000:>9.2f} {rerun * 1000:>9.3f} {sent / 1024:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
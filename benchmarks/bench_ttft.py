@@ -0,0 +1,68 @@
+# benchmarks/bench_ttft.py
+"""Time-to-first-token: fresh client + asyncio.run per reply vs the shared pooled client.
+
+Runs against the local fake server, so no API key or network is needed.
+
+Usage: python benchmarks/bench_ttft.py [--requests 50]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import AsyncOpenAI  # noqa: E402
+
+import openai_client  # noqa: E402
+from fake_openai import start_server  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "tell me a joke"}]
+
+
+async def first_token(client):
+    start = time.perf_counter()
+    stream = await client.chat.completions.create(model="gpt-3.5-turbo", messages=MESSAGES, stream=True)
+    ttft = None
+    async for chunk in stream:
+        if ttft is None and chunk.choices and chunk.choices[0].delta.content:
+            ttft = time.perf_counter() - start
+    return ttft
+
+
+def per_request_client(base_url):
+    async def once():
+        client = AsyncOpenAI(api_key="test", base_url=base_url)
+        try:
+            return await first_token(client)
+        finally:
+            await client.close()
+    return asyncio.run(once())
+
+
+def shared_client(base_url):
+    return openai_client.run(first_token(openai_client.get_client("test", base_url)))
+
+
+def report(label, samples):
+    samples = sorted(s * 1000 for s in samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{label:<22} mean {statistics.mean(samples):7.2f} ms  p50 {statistics.median(samples):7.2f} ms  p95 {p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    server, base_url = start_server(tokens=20)
+    report("per-request client", [per_request_client(base_url) for _ in range(args.requests)])
+    report("shared pooled client", [shared_client(base_url) for _ in range(args.requests)])
+    openai_client.shutdown()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# benchmarks/fake_mailersend.py
+"""Local stand-in for the MailerSend email API.
+
+Accepts POST /v1/email and POST /v1/bulk-email with 202 and records every
+message it receives; GET /v1/bulk-email/<id> reports a completed batch, with
+recipients containing "invalid" listed as validation errors.
+Responses can be scripted with a list of status codes (consumed in order)
+or randomised with an error rate, to exercise retries and backoff.
+
+Usage: python benchmarks/fake_mailersend.py --port 8902
+       then set MAILER_SEND_URL=http://127.0.0.1:8902/v1/email
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeMailerSendHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _next_status(self):
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+            if server.script:
+                return server.script.pop(0)
+        if random.random() < server.config["error_rate"]:
+            return server.config["error_status"]
+        return None
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(server.config["latency_ms"] / 1000)
+
+        status = self._next_status()
+        if status is not None and status != 202:
+            headers = {"Retry-After": "0"} if status == 429 else None
+            self._reply(status, {"message": "injected failure"}, headers)
+            return
+
+        if self.path.rstrip("/").endswith("/bulk-email"):
+            with server.lock:
+                server.messages.extend(body)
+                bulk_id = f"bulk-{len(server.bulks) + 1}"
+                server.bulks[bulk_id] = body
+            self._reply(202, {"message": "The bulk email is being processed.", "bulk_email_id": bulk_id})
+            return
+
+        with server.lock:
+            server.messages.append(body)
+        self._reply(202, headers={"X-Message-Id": f"fake-{len(server.messages)}"})
+
+    def do_GET(self):
+        bulk_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+        with self.server.lock:
+            messages = self.server.bulks.get(bulk_id)
+        if messages is None:
+            self._reply(404, {"message": "Not found"})
+            return
+        errors = {
+            f"message.{i}.to.0.email": ["The email must be a valid email address."]
+            for i, message in enumerate(messages)
+            if "invalid" in message["to"][0]["email"]
+        }
+        self._reply(200, {"data": {
+            "id": bulk_id,
+            "state": "completed",
+            "total_recipients_count": len(messages),
+            "validation_errors_count": len(errors),
+            "validation_errors": errors or None,
+        }})
+
+
+def start_server(port=0, latency_ms=0, error_rate=0.0, error_status=503, script=None):
+    """Start the fake server on a daemon thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeMailerSendHandler)
+    server.daemon_threads = True
+    server.config = {"latency_ms": latency_ms, "error_rate": error_rate, "error_status": error_status}
+    server.script = list(script or [])
+    server.messages = []
+    server.bulks = {}
+    server.stats = {"requests": 0}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake MailerSend server")
+    parser.add_argument("--port", type=int, default=8902)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+    server, base_url = start_server(args.port, args.latency_ms, args.error_rate, args.error_status)
+    print(f"Fake MailerSend server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
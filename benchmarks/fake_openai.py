@@ -0,0 +1,128 @@
+# benchmarks/fake_openai.py
+"""Local stand-in for the OpenAI chat completions streaming endpoint.
+
+Serves POST /v1/chat/completions as server-sent events over HTTP/1.1
+keep-alive, so client-side connection reuse is visible in timings.
+
+Usage: python benchmarks/fake_openai.py --port 8901 --first-token-ms 50
+       then set OPENAI_BASE_URL=http://127.0.0.1:8901/v1
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "Why did the scarecrow win an award? Because he was outstanding in his field!"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Real servers flush SSE frames immediately; without this, Nagle plus
+    # delayed ACKs add ~40 ms to every reused connection.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        try:
+            self._handle_completion()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up (deadline, hedge loser); expected
+
+    def _handle_completion(self):
+        config = self.server.config
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.stats_lock:
+            self.server.stats["requests"] += 1
+
+        if random.random() < config["error_rate"]:
+            payload = json.dumps({"error": {"message": "injected failure"}}).encode()
+            self.send_response(config["error_status"])
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        time.sleep(config["first_token_ms"] / 1000)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        model = body.get("model", "gpt-3.5-turbo")
+        words = config["reply"].split(" ")
+        tokens = [w + (" " if i < len(words) - 1 else "") for i, w in enumerate(words)]
+        tokens = (tokens * (config["tokens"] // max(len(tokens), 1) + 1))[:config["tokens"]]
+        delay = 1 / config["tokens_per_sec"] if config["tokens_per_sec"] else 0
+        for i, token in enumerate(tokens):
+            if i and delay:
+                time.sleep(delay)
+            event = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": token}, "finish_reason": None}],
+            }
+            self._send_chunk(f"data: {json.dumps(event)}\n\n".encode())
+        done = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        self._send_chunk(f"data: {json.dumps(done)}\n\n".encode())
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+
+def start_server(port=0, tokens=20, tokens_per_sec=0, first_token_ms=0,
+                 error_rate=0.0, error_status=503, reply=DEFAULT_REPLY):
+    """Start the fake server on a daemon thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.config = {
+        "tokens": tokens,
+        "tokens_per_sec": tokens_per_sec,
+        "first_token_ms": first_token_ms,
+        "error_rate": error_rate,
+        "error_status": error_status,
+        "reply": reply,
+    }
+    server.stats = {"requests": 0}
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI streaming server")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--tokens-per-sec", type=float, default=0)
+    parser.add_argument("--first-token-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+    server, base_url = start_server(args.port, args.tokens, args.tokens_per_sec,
+                                    args.first_token_ms, args.error_rate, args.error_status)
+    print(f"Fake OpenAI server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
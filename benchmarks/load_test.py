@@ -0,0 +1,338 @@
+# benchmarks/load_test.py
+"""Load test: N concurrent simulated users against local fake upstreams.
+
+Scenarios:
+  chat           Runner.run_streamed against the fake OpenAI server
+  auth           db.register_user, then db.authenticate_user
+  otp            otp_sender.send_otp_email against the fake MailerSend, until sent
+  conversations  conversation_store save (append) and read_window per turn
+
+Each scenario reports p50/p95/p99 latency, throughput and errors; chat also
+reports time-to-first-token. Each scenario runs in a fresh process, so its
+peak RSS is that scenario's own high-water mark, not the run's so far. Results can be saved as a JSON baseline and later runs compared
+against it; a metric that is worse by more than --tolerance (and by more than
+--min-delta-ms for timings) is flagged and the exit status is 1.
+
+Usage: python benchmarks/load_test.py [--users 16] [--iterations 20]
+       python benchmarks/load_test.py --save-baseline
+       python benchmarks/load_test.py --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agents  # noqa: E402
+import conversation_store  # noqa: E402
+import db  # noqa: E402
+import hashing  # noqa: E402
+import jokes  # noqa: E402
+import openai_client  # noqa: E402
+import otp_sender  # noqa: E402
+import response_cache  # noqa: E402
+import singleflight  # noqa: E402
+import fake_mailersend  # noqa: E402
+import fake_openai  # noqa: E402
+
+SCENARIOS = ["chat", "auth", "otp", "conversations"]
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+PASSWORD = "correct horse battery staple"
+
+
+def percentiles(samples):
+    """Nearest-rank p50/p95/p99 in milliseconds."""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))] * 1000
+    return {"p50": round(pick(0.50), 3), "p95": round(pick(0.95), 3), "p99": round(pick(0.99), 3)}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.ttfts = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, ttft=None, error=False):
+        with self._lock:
+            if error:
+                self.errors += 1
+                return
+            self.latencies.append(latency)
+            if ttft is not None:
+                self.ttfts.append(ttft)
+
+
+def run_users(users, iterations, fn, warmup=False):
+    """Run fn(user, i) for every user concurrently; returns (Recorder, elapsed seconds).
+
+    With `warmup`, one untimed call first pays one-off costs (client creation,
+    worker process start-up) so they don't land in the percentiles.
+    """
+    if warmup:
+        fn(-1, 0, Recorder())
+    recorder = Recorder()
+
+    def user_loop(user):
+        for i in range(iterations):
+            fn(user, i, recorder)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        for future in [pool.submit(user_loop, user) for user in range(users)]:
+            future.result()
+    return recorder, time.perf_counter() - start
+
+
+# ─── SCENARIOS ───
+def chat_op(agent):
+    def op(user, i, recorder):
+        start = time.perf_counter()
+        ttft = None
+        text = []
+        try:
+            result = agents.Runner.run_streamed(agent, f"user {user} asks question {i}: tell me a story", f"User{user}")
+            for event in openai_client.iterate(result.stream_events()):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                text.append(agents.ItemHelpers.text_message_output(event.item))
+        except Exception:
+            recorder.record(0, error=True)
+            return
+        # The fallback joke means the upstream call failed.
+        recorder.record(time.perf_counter() - start, ttft, error="".join(text) == agents.FALLBACK_MESSAGE)
+    return op
+
+
+def auth_op(user, i, recorder):
+    email = f"load-{user}-{i}@example.com"
+    start = time.perf_counter()
+    try:
+        db.register_user(email, f"User{user}", PASSWORD)
+        ok = db.authenticate_user(email, PASSWORD) is not None
+    except hashing.HashingBusy:
+        ok = False
+    recorder.record(time.perf_counter() - start, error=not ok)
+
+
+def otp_op(timeout):
+    def op(user, i, recorder):
+        email = f"otp-{user}-{i}@example.com"
+        start = time.perf_counter()
+        if not otp_sender.send_otp_email(email, f"{i:06d}"):
+            recorder.record(0, error=True)
+            return
+        deadline = start + timeout
+        while time.perf_counter() < deadline:
+            status = otp_sender.message_status(email)
+            if status in (otp_sender.SENT, otp_sender.FAILED):
+                recorder.record(time.perf_counter() - start, error=status == otp_sender.FAILED)
+                return
+            time.sleep(0.005)
+        recorder.record(0, error=True)
+    return op
+
+
+def conversations_op(history):
+    def op(user, i, recorder):
+        email = f"conv-{user}@example.com"
+        conv_id = f"chat_load_{user}"
+        if i == 0:
+            entry = conversation_store.add_conversation(email, conv_id)
+            seed = [{"role": "user" if n % 2 == 0 else "assistant", "content": f"message {n} " + "ha" * 40}
+                    for n in range(history)]
+            conversation_store.save_conversation(email, conv_id, entry["file"], seed)
+        file_path = conversation_store.conversation_file(email, conv_id)
+        start = time.perf_counter()
+        try:
+            offset, messages = conversation_store.read_window(file_path, 200)
+            messages.append({"role": "user", "content": f"turn {i}"})
+            conversation_store.save_conversation(email, conv_id, file_path, messages, offset=offset)
+        except Exception:
+            recorder.record(0, error=True)
+            return
+        recorder.record(time.perf_counter() - start)
+    return op
+
+
+def summarize(recorder, elapsed):
+    ops = len(recorder.latencies)
+    result = {
+        "ops": ops,
+        "errors": recorder.errors,
+        "throughput": round(ops / elapsed, 2) if elapsed else None,
+        "latency_ms": percentiles(recorder.latencies),
+    }
+    if recorder.ttfts:
+        result["ttft_ms"] = percentiles(recorder.ttfts)
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def run(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "load.db")
+        db.init_db()
+        conversation_store.USER_DATA_DIR = os.path.join(tmp, "user_data")
+
+        if "chat" in args.scenarios:
+            server, base_url = fake_openai.start_server(
+                tokens=args.tokens, tokens_per_sec=args.tokens_per_sec,
+                first_token_ms=args.first_token_ms, error_rate=args.error_rate)
+            os.environ["OPENAI_API_KEY"] = "load-test"
+            os.environ["OPENAI_BASE_URL"] = base_url
+            # Every request goes upstream: no local jokes, cache or request sharing.
+            jokes.LOCAL_JOKES = False
+            response_cache.RESPONSE_CACHE_BACKEND = "off"
+            singleflight.SINGLEFLIGHT = False
+            agent = agents.Agent(name="JokeBot", instructions=agents.JOKEBOT_INSTRUCTIONS)
+            results["chat"] = summarize(*run_users(args.users, args.iterations, chat_op(agent), warmup=True))
+            openai_client.shutdown()
+            server.shutdown()
+
+        if "auth" in args.scenarios:
+            hashing.BCRYPT_ROUNDS = args.bcrypt_rounds
+            results["auth"] = summarize(*run_users(args.users, args.iterations, auth_op, warmup=True))
+            hashing.shutdown()
+
+        if "otp" in args.scenarios:
+            server, base_url = fake_mailersend.start_server(latency_ms=args.mail_latency_ms,
+                                                            error_rate=args.error_rate)
+            otp_sender.API_KEY = "load-test"
+            otp_sender.SENDER_EMAIL = "load@example.com"
+            otp_sender.MAILER_SEND_URL = f"{base_url}/email"
+            otp_sender.MAILER_SEND_BULK_URL = f"{base_url}/bulk-email"
+            otp_sender.BACKOFF_BASE = 0.05
+            results["otp"] = summarize(*run_users(args.users, args.iterations, otp_op(args.otp_timeout),
+                                                   warmup=True))
+            server.shutdown()
+
+        if "conversations" in args.scenarios:
+            results["conversations"] = summarize(*run_users(args.users, args.iterations,
+                                                            conversations_op(args.history)))
+        db.get_pool().close()
+    return results
+
+
+def run_isolated(args):
+    """run() each scenario in its own spawned process; ru_maxrss never goes
+    down, so sharing a process would charge earlier scenarios' memory to later ones."""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in args.scenarios:
+        scenario_args = argparse.Namespace(**{**vars(args), "scenarios": [name]})
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results.update(pool.submit(run, scenario_args).result())
+    return results
+
+
+# ─── BASELINE ───
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Metrics worse than the baseline by more than the tolerance, as printable lines."""
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        checks = []
+        for group in ("latency_ms", "ttft_ms"):
+            for q in ("p50", "p95", "p99"):
+                checks.append((f"{group}.{q}", (current.get(group) or {}).get(q),
+                               (before.get(group) or {}).get(q), True))
+        checks.append(("throughput", current.get("throughput"), before.get("throughput"), False))
+        checks.append(("peak_rss_mb", current.get("peak_rss_mb"), before.get("peak_rss_mb"), True))
+        for metric, now, then, higher_is_worse in checks:
+            if now is None or not then:
+                continue
+            change = (now - then) / then if higher_is_worse else (then - now) / then
+            timing = metric.endswith(("p50", "p95", "p99"))
+            if change > tolerance and (not timing or abs(now - then) > min_delta_ms):
+                regressions.append(f"{name}.{metric}: {then:g} -> {now:g} ({change:+.0%})")
+        if current["errors"] > before.get("errors", 0) and current["errors"] > tolerance * max(current["ops"], 1):
+            regressions.append(f"{name}.errors: {before.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def print_table(results):
+    print(f"{'scenario':<14} {'ops':>6} {'err':>5} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'ttft p50':>9} {'ttft p95':>9} {'rss MB':>8}")
+    fmt = lambda v: f"{v:9.2f}" if v is not None else f"{'-':>9}"
+    for name, r in results.items():
+        ttft = r.get("ttft_ms") or {}
+        print(f"{name:<14} {r['ops']:>6} {r['errors']:>5} {fmt(r['throughput'])} "
+              f"{fmt(r['latency_ms']['p50'])} {fmt(r['latency_ms']['p95'])} {fmt(r['latency_ms']['p99'])} "
+              f"{fmt(ttft.get('p50'))} {fmt(ttft.get('p95'))} {r['peak_rss_mb']:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=16, help="concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=20, help="operations per user per scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda s: [x for x in s.split(",") if x], help="comma-separated subset")
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--tokens-per-sec", type=float, default=400)
+    parser.add_argument("--first-token-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="injected upstream error rate")
+    parser.add_argument("--mail-latency-ms", type=float, default=20)
+    parser.add_argument("--otp-timeout", type=float, default=30)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="low by default so the DB path dominates")
+    parser.add_argument("--history", type=int, default=1000, help="messages per seeded conversation")
+    parser.add_argument("--output", help="write this run's results as JSON")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="write results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="ignore smaller timing changes")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = run_isolated(args)
+    print_table(results)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "save_baseline")},
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("No regressions against baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# context_window.py
+"""Token-budgeted prompt building from conversation history.
+
+The most recent turns are sent verbatim; older turns are folded into a short
+rolling summary. The summary is cached per conversation and only recomputed
+when the window start moves, which happens in steps (the recent part is cut
+back to RECENT_SHARE of the budget) so it is not redone on every message.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "300"))
+RECENT_SHARE = 0.6
+MESSAGE_OVERHEAD = 4  # role and separator tokens per chat message
+CACHE_SIZE = 1024
+
+_WORD = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def estimate_tokens(text):
+    """Cheap local token estimate: ~4 characters per token, floored at the word count."""
+    if not text:
+        return 0
+    return max(len(text) // 4, len(_WORD.findall(text)) * 3 // 4, 1)
+
+
+def message_tokens(message):
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD
+
+
+def summarize(previous, messages, budget=SUMMARY_TOKEN_BUDGET):
+    """Fold messages into a running summary without a model call.
+
+    Keeps the first sentence of each turn, newest last, trimmed from the
+    front so the result stays within `budget` tokens.
+    """
+    lines = previous.splitlines() if previous else []
+    for message in messages:
+        content = " ".join(message.get("content", "").split())
+        if not content:
+            continue
+        first = _SENTENCE_END.split(content, 1)[0][:200]
+        lines.append(f"{message.get('role', 'user')}: {first}")
+    while lines and estimate_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class _SummaryCache:
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+_cache = _SummaryCache()
+
+
+def _fingerprint(history, start):
+    """Identifies the summarized prefix so an edited or different history is not reused."""
+    if start == 0:
+        return None
+    last = history[start - 1]
+    return (last.get("role"), last.get("content"), last.get("timestamp"))
+
+
+def build_messages(system_prompt, history, user_input, conversation_id=None,
+                   budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET):
+    """Return the chat messages to send: system prompt, optional summary, recent turns, input."""
+    history = [m for m in (history or []) if m.get("role") in ("user", "assistant")]
+    fixed = estimate_tokens(system_prompt) + estimate_tokens(user_input) + 2 * MESSAGE_OVERHEAD
+
+    start, summary = 0, ""
+    cached = _cache.get(conversation_id) if conversation_id else None
+    if cached and cached[0] <= len(history) and cached[2] == _fingerprint(history, cached[0]):
+        start, summary = cached[0], cached[1]
+
+    costs = [message_tokens(m) for m in history]
+    recent = sum(costs[start:])
+    summary_cost = estimate_tokens(summary) + MESSAGE_OVERHEAD if summary else 0
+    if fixed + summary_cost + recent > budget:
+        # Slide the window forward until the recent turns use at most
+        # RECENT_SHARE of what is left, then fold the dropped turns in once.
+        target = max(0, (budget - fixed - summary_budget - MESSAGE_OVERHEAD) * RECENT_SHARE)
+        new_start = start
+        while new_start < len(history) and recent > target:
+            recent -= costs[new_start]
+            new_start += 1
+        summary = summarize(summary, history[start:new_start], summary_budget)
+        start = new_start
+        if conversation_id:
+            _cache.put(conversation_id, (start, summary, _fingerprint(history, start)))
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+    messages.extend({"role": m["role"], "content": m["content"]} for m in history[start:])
+    messages.append({"role": "user", "content": user_input})
+    return messages
@@ -0,0 +1,364 @@
+# conversation_store.py
+import functools
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+import metrics
+from log_config import error_text, mask_email
+
+logger = logging.getLogger(__name__)
+
+USER_DATA_DIR = "user_data"
+INDEX_FILE = "_index.json"
+INDEX_VERSION = 1
+
+# "jsonl" appends one message per line; "json" rewrites the whole list on save.
+STORAGE_FORMAT = os.getenv("CONVERSATION_FORMAT", "jsonl")
+# Rewrite a JSON Lines log after this many appends to drop torn trailing lines.
+COMPACT_EVERY = int(os.getenv("CONVERSATION_COMPACT_EVERY", "200"))
+
+FILE_IO_SECONDS = metrics.histogram("jokebot_conversation_io_seconds", "Conversation file read/write time", ["op"])
+
+
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+
+def _locked(fn):
+    """Serialize index updates per user; the script thread and generation workers both write."""
+    @functools.wraps(fn)
+    def wrapper(email, *args, **kwargs):
+        with _user_locks_lock:
+            lock = _user_locks.setdefault(email, threading.RLock())
+        with lock:
+            return fn(email, *args, **kwargs)
+    return wrapper
+
+
+def conversation_dir(email):
+    return os.path.join(USER_DATA_DIR, f"{email}_conversations")
+
+
+def index_path(email):
+    return os.path.join(conversation_dir(email), INDEX_FILE)
+
+
+def default_title(conv_id):
+    parts = conv_id.split("_")
+    return f"Chat - {parts[1] if len(parts) > 1 else conv_id}"
+
+
+def title_for(messages, conv_id):
+    if messages:
+        return messages[0]["content"][:30] + "..."
+    return default_title(conv_id)
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _write_index(email, entries):
+    """Atomically replace the index file so readers never see a partial write."""
+    path = index_path(email)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": INDEX_VERSION, "conversations": entries}, f)
+    os.replace(tmp_path, path)
+
+
+def _read_index(email):
+    with open(index_path(email), "r") as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or data.get("version") != INDEX_VERSION:
+        raise ValueError("unsupported index format")
+    entries = data["conversations"]
+    if not isinstance(entries, dict):
+        raise ValueError("malformed index entries")
+    return entries
+
+
+def _is_conversation_file(filename):
+    return filename.endswith((".json", ".jsonl")) and filename != INDEX_FILE
+
+
+def _conversation_id(filename):
+    return os.path.splitext(filename)[0]
+
+
+def conversation_file(email, conv_id, fmt=None):
+    ext = ".jsonl" if (fmt or STORAGE_FORMAT) == "jsonl" else ".json"
+    return os.path.join(conversation_dir(email), f"{conv_id}{ext}")
+
+
+# ─── MESSAGE FILES ───
+@metrics.timed(FILE_IO_SECONDS, op="read")
+def read_messages(file_path):
+    """Read a conversation stored either as a JSON list or as JSON Lines."""
+    if not file_path.endswith(".jsonl"):
+        with open(file_path, "r") as f:
+            return json.load(f)
+    messages = []
+    with open(file_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                messages.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A crash mid-append leaves a torn last line; compaction drops it.
+                logger.warning("Skipping unreadable line in conversation %s", _conversation_id(os.path.basename(file_path)))
+    return messages
+
+
+@metrics.timed(FILE_IO_SECONDS, op="read_window")
+def read_window(file_path, count, end=None):
+    """Read up to `count` messages ending before position `end` (default: the end).
+
+    Returns (start, messages), where `start` is the position of the first
+    message returned. JSON Lines files only parse the lines in the window; a
+    torn line is compacted away first so positions match the indexed count.
+    """
+    if not file_path.endswith(".jsonl"):
+        messages = read_messages(file_path)
+        end = len(messages) if end is None else min(end, len(messages))
+        start = max(0, end - count)
+        return start, messages[start:end]
+    with open(file_path, "rb") as f:
+        lines = [line for line in f.read().split(b"\n") if line.strip()]
+    end = len(lines) if end is None else min(end, len(lines))
+    start = max(0, end - count)
+    try:
+        return start, [json.loads(line) for line in lines[start:end]]
+    except json.JSONDecodeError:
+        compact(file_path)
+        return read_window(file_path, count, end)
+
+
+@metrics.timed(FILE_IO_SECONDS, op="append")
+def append_messages(file_path, messages):
+    """Append messages to a JSON Lines log with a single buffered write."""
+    if not messages:
+        return
+    payload = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8")
+    with open(file_path, "a+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b"\n":
+                # Never glue a new message onto a torn line left by a crash.
+                payload = b"\n" + payload
+        f.write(payload)
+
+
+@metrics.timed(FILE_IO_SECONDS, op="write")
+def write_messages(file_path, messages):
+    """Replace a conversation file atomically in whichever format its extension names."""
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if file_path.endswith(".jsonl"):
+            f.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages))
+        else:
+            json.dump(messages, f, indent=2)
+    os.replace(tmp_path, file_path)
+
+
+def compact(file_path):
+    """Rewrite a JSON Lines log, dropping blank or torn lines."""
+    messages = read_messages(file_path)
+    write_messages(file_path, messages)
+    return messages
+
+
+def rebuild_index(email):
+    """Rebuild the index by scanning every conversation file on disk."""
+    directory = conversation_dir(email)
+    entries = {}
+    try:
+        files = sorted(f for f in os.listdir(directory) if _is_conversation_file(f))
+    except FileNotFoundError:
+        logger.warning("Conversation directory for user %s not found", mask_email(email))
+        files = []
+    for f in files:
+        file_path = os.path.join(directory, f)
+        conv_id = _conversation_id(f)
+        try:
+            messages = read_messages(file_path)
+            title = title_for(messages, conv_id)
+        except (FileNotFoundError, json.JSONDecodeError, IndexError, KeyError, TypeError) as e:
+            logger.warning("Failed to load conversation %s: %s", conv_id, error_text(e))
+            messages = []
+            title = default_title(conv_id)
+        try:
+            stat = os.stat(file_path)
+            size = stat.st_size
+            updated = datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M:%S")
+        except FileNotFoundError:
+            size, updated = 0, _now()
+        entries[conv_id] = {
+            "id": conv_id,
+            "title": title,
+            "file": file_path,
+            "created": updated,
+            "updated": updated,
+            "message_count": len(messages) if isinstance(messages, list) else 0,
+            "size": size,
+        }
+    if os.path.isdir(directory):
+        _write_index(email, entries)
+    logger.info("Rebuilt conversation index for user %s (%s conversations)", mask_email(email), len(entries))
+    return entries
+
+
+def load_index(email):
+    """Return the user's conversation index, rebuilding it if missing or corrupt."""
+    try:
+        return _read_index(email)
+    except FileNotFoundError:
+        logger.info("No conversation index for user %s, rebuilding", mask_email(email))
+    except (json.JSONDecodeError, ValueError, KeyError) as e:
+        logger.warning("Corrupt conversation index for user %s: %s", mask_email(email), e)
+    return rebuild_index(email)
+
+
+def list_conversations(email):
+    """Sidebar entries ({"id", "title", "file", ...}) read from the index only."""
+    return sorted(load_index(email).values(), key=lambda c: c["id"])
+
+
+@_locked
+def add_conversation(email, conv_id):
+    """Create an empty conversation file in the configured format and index it."""
+    file_path = conversation_file(email, conv_id)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    write_messages(file_path, [])
+    entries = load_index(email)
+    now = _now()
+    entry = {
+        "id": conv_id,
+        "title": default_title(conv_id),
+        "file": file_path,
+        "created": now,
+        "updated": now,
+        "message_count": 0,
+        "appends": 0,
+        "size": os.path.getsize(file_path),
+    }
+    entries[conv_id] = entry
+    _write_index(email, entries)
+    return entry
+
+
+@_locked
+def save_conversation(email, conv_id, file_path, messages, offset=0):
+    """Persist messages and update the index entry.
+
+    `messages` may be a window of the conversation starting at position
+    `offset` (see read_window); everything before it is assumed to be on
+    disk already. JSON Lines files only get the messages past the indexed
+    message_count appended; legacy .json files are rewritten in full.
+
+    A save with nothing new (switching chats, logging out) touches neither
+    the file nor the index, so it doesn't bump the chat's `updated` time. If
+    the file already holds more messages than `offset + len(messages)` (a
+    generation worker or another tab appended to it), nothing is written
+    either and the returned entry's message_count tells the caller to reload.
+    """
+    entries = load_index(email)
+    entry = entries.get(conv_id) or {"id": conv_id, "created": _now()}
+    persisted = entry.get("message_count", 0) if entry.get("file") == file_path else 0
+    appends = entry.get("appends", 0)
+    total = offset + len(messages)
+    if conv_id in entries and persisted >= total and os.path.exists(file_path):
+        return entry
+    if file_path.endswith(".jsonl") and offset <= persisted <= total and os.path.exists(file_path):
+        append_messages(file_path, messages[persisted - offset:])
+        appends += 1
+        if appends >= COMPACT_EVERY:
+            compact(file_path)
+            appends = 0
+    else:
+        if offset:
+            messages = read_window(file_path, offset, offset)[1] + messages
+        write_messages(file_path, messages)
+        appends = 0
+    entry.update({
+        "title": entry["title"] if offset and entry.get("title") else title_for(messages, conv_id),
+        "file": file_path,
+        "updated": _now(),
+        "message_count": total,
+        "appends": appends,
+        "size": os.path.getsize(file_path),
+    })
+    entries[conv_id] = entry
+    _write_index(email, entries)
+    return entry
+
+
+@_locked
+def append_message(email, conv_id, message):
+    """Append one message to an indexed conversation; used by generation workers.
+
+    Returns (position, entry), or None if the conversation no longer exists.
+    """
+    entries = load_index(email)
+    entry = entries.get(conv_id)
+    if entry is None or not os.path.exists(entry["file"]):
+        return None
+    file_path = entry["file"]
+    position = entry.get("message_count", 0)
+    appends = entry.get("appends", 0)
+    if file_path.endswith(".jsonl"):
+        append_messages(file_path, [message])
+        appends += 1
+        if appends >= COMPACT_EVERY:
+            compact(file_path)
+            appends = 0
+    else:
+        write_messages(file_path, read_messages(file_path) + [message])
+        appends = 0
+    if not position:
+        entry["title"] = title_for([message], conv_id)
+    entry.update({
+        "updated": _now(),
+        "message_count": position + 1,
+        "appends": appends,
+        "size": os.path.getsize(file_path),
+    })
+    _write_index(email, entries)
+    return position, entry
+
+
+@_locked
+def clear_index(email):
+    _write_index(email, {})
+
+
+@_locked
+def migrate_to_jsonl(email):
+    """Convert a user's legacy .json conversations to JSON Lines. Returns the count migrated."""
+    entries = load_index(email)
+    migrated = 0
+    for entry in entries.values():
+        old_path = entry["file"]
+        if old_path.endswith(".jsonl"):
+            continue
+        try:
+            messages = read_messages(old_path)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logger.warning("Skipping conversation %s: %s", entry['id'], error_text(e))
+            continue
+        new_path = conversation_file(email, entry["id"], "jsonl")
+        write_messages(new_path, messages)
+        os.remove(old_path)
+        entry.update({"file": new_path, "message_count": len(messages),
+                      "appends": 0, "size": os.path.getsize(new_path)})
+        migrated += 1
+    _write_index(email, entries)
+    logger.info("Migrated %s conversations to JSON Lines for user %s", migrated, mask_email(email))
+    return migrated
@@ -1,29 +1,263 @@
+import logging
+import os
+import queue
 import sqlite3
-from bcrypt import hashpw, gensalt, checkpw
+import threading
+from contextlib import contextmanager
+from hashing import HashingBusy, hash_password, needs_rehash, verify_password
+import metrics
+from log_config import mask_email
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("USERS_DB", "users.db")
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+STATEMENT_CACHE_SIZE = 128
+
+DB_QUERY_SECONDS = metrics.histogram("jokebot_db_query_seconds", "SQLite helper call time", ["op"])
+DB_POOL_WAIT_SECONDS = metrics.histogram("jokebot_db_pool_wait_seconds", "Time waiting for a pooled connection")
+AUTH_SECONDS = metrics.histogram("jokebot_auth_seconds", "Register/login time, bcrypt included", ["op"])
+
+# ─── CONNECTION POOL ───
+class ConnectionPool:
+    """A bounded pool of SQLite connections shared by all script threads.
+
+    Connections run in WAL mode with synchronous=NORMAL so readers never block
+    behind a writer, and each keeps a prepared-statement cache that survives
+    across calls because the connection itself is reused.
+    """
+    def __init__(self, path, size=POOL_SIZE, busy_timeout_ms=BUSY_TIMEOUT_MS):
+        self.path = path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.busy_timeout_ms / 1000)
+        except queue.Empty:
+            raise sqlite3.OperationalError("connection pool exhausted") from None
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection; commits on success, rolls back on error."""
+    pool = get_pool()
+    with DB_POOL_WAIT_SECONDS.time():
+        conn = pool.acquire()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+@metrics.timed(DB_QUERY_SECONDS, op="query_one")
+def query_one(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+@metrics.timed(DB_QUERY_SECONDS, op="query_all")
+def query_all(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+@metrics.timed(DB_QUERY_SECONDS, op="execute")
+def execute(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).rowcount
+
+# ─── SCHEMA ───
+# Append-only list of (version, statements). Each version is applied once, in
+# order, and recorded in PRAGMA user_version. Never edit a shipped entry; add
+# a new one instead.
+MIGRATIONS = [
+    (1, [
+        '''CREATE TABLE IF NOT EXISTS users (
+            email TEXT PRIMARY KEY,
+            name TEXT,
+            password_hash TEXT
+        )''',
+    ]),
+    (2, [
+        '''CREATE TABLE IF NOT EXISTS otp_codes (
+            email TEXT PRIMARY KEY,
+            code TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_otp_codes_expires_at ON otp_codes (expires_at)",
+    ]),
+    (3, [
+        '''CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            last_error TEXT
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_recipient ON email_outbox (recipient, status)",
+    ]),
+    (4, [
+        "ALTER TABLE email_outbox ADD COLUMN bulk_id TEXT",
+        "ALTER TABLE email_outbox ADD COLUMN bulk_index INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_bulk ON email_outbox (bulk_id)",
+    ]),
+    (5, [
+        '''CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )''',
+    ]),
+    (6, [
+        '''CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)",
+    ]),
+    (7, [
+        # `owner` holds one opaque token per user so a search is a posting-list
+        # intersection inside FTS rather than a filter over every user's hits.
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+            content,
+            owner,
+            conversation_id UNINDEXED,
+            position UNINDEXED,
+            role UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )''',
+        '''CREATE TABLE IF NOT EXISTS search_progress (
+            email TEXT NOT NULL,
+            conversation_id TEXT NOT NULL,
+            indexed_count INTEGER NOT NULL,
+            PRIMARY KEY (email, conversation_id)
+        )''',
+    ]),
+]
+
+_initialized = set()
+
+def schema_version():
+    return query_one("PRAGMA user_version")[0]
+
+def migrate():
+    """Apply pending migrations. Safe to run from several processes at once."""
+    with connection() as conn:
+        # BEGIN IMMEDIATE takes the write lock before reading user_version, so
+        # two processes starting together cannot both apply the same step.
+        conn.execute("BEGIN IMMEDIATE")
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={int(version)}")
+            current = version
+    return current
 
 def init_db():
-    conn = sqlite3.connect("users.db")
-    conn.execute('''CREATE TABLE IF NOT EXISTS users (
-        email TEXT PRIMARY KEY,
-        name TEXT,
-        password_hash TEXT
-    )''')
-    conn.commit()
-    conn.close()
+    """Bootstrap the schema once per process and database path."""
+    with _pool_lock:
+        if DB_PATH in _initialized:
+            return
+    migrate()
+    with _pool_lock:
+        _initialized.add(DB_PATH)
+
+# ─── USERS ───
+
+def insert_user(email, name, password_hash):
+    execute("INSERT INTO users (email, name, password_hash) VALUES (?, ?, ?)",
+            (email, name, password_hash))
 
+def set_password_hash(email, password_hash):
+    return execute("UPDATE users SET password_hash = ? WHERE email = ?", (password_hash, email))
+
+@metrics.timed(AUTH_SECONDS, op="register")
 def register_user(email, name, password):
-    hashed = hashpw(password.encode(), gensalt())
-    conn = sqlite3.connect("users.db")
-    conn.execute("INSERT INTO users (email, name, password_hash) VALUES (?, ?, ?)",
-                 (email, name, hashed))
-    conn.commit()
-    conn.close()
+    hashed = hash_password(password)
+    insert_user(email, name, hashed)
 
+@metrics.timed(AUTH_SECONDS, op="authenticate")
 def authenticate_user(email, password):
-    conn = sqlite3.connect("users.db")
-    cursor = conn.execute("SELECT name, password_hash FROM users WHERE email=?", (email,))
-    row = cursor.fetchone()
-    conn.close()
-    if row and checkpw(password.encode(), row[1]):
+    row = query_one("SELECT name, password_hash FROM users WHERE email=?", (email,))
+    if row and verify_password(password, row[1]):
+        if needs_rehash(row[1]):
+            _upgrade_hash(email, password)
         return {"email": email, "name": row[0]}
-    return None
\ No newline at end of file
+    return None
+
+def _upgrade_hash(email, password):
+    """Re-hash at the configured work factor after a successful login."""
+    try:
+        set_password_hash(email, hash_password(password))
+    except HashingBusy:
+        pass  # Best effort; the next login will try again.
+    except sqlite3.Error as e:
+        logger.warning("Could not upgrade password hash for %s: %s", mask_email(email), e)
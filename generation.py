@@ -0,0 +1,150 @@
+# generation.py
+"""Reply generation that outlives the Streamlit script run.
+
+submit() starts a job on the shared event loop and returns at once. The job
+streams the reply into its own chunk buffer and, when the stream ends,
+appends the assistant message to the conversation file itself, so a rerun
+or a closed tab no longer loses the reply. The UI polls a job's snapshot()
+instead of waiting on it, so no script thread is held for the length of a
+reply, and a session that comes back mid-reply simply draws what is
+buffered so far.
+
+At most GENERATION_WORKERS jobs stream at once; later ones wait their turn.
+Finished jobs are kept for GENERATION_JOB_TTL seconds so a reconnecting
+session can still pick up the result.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import conversation_store
+import metrics
+import openai_client
+import search_index
+from agents import ItemHelpers, Runner
+from log_config import error_text
+
+logger = logging.getLogger(__name__)
+
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "64"))
+GENERATION_JOB_TTL = float(os.getenv("GENERATION_JOB_TTL", "600"))
+
+QUEUE_SECONDS = metrics.histogram("jokebot_generation_queue_seconds", "Time a job waited for a worker slot")
+JOBS = metrics.counter("jokebot_generation_jobs_total", "Generation jobs by outcome", ["outcome"])
+
+
+class Job:
+    def __init__(self, email, conversation_id):
+        self.id = uuid.uuid4().hex
+        self.email = email
+        self.conversation_id = conversation_id
+        self.chunks = []
+        self.message = None     # the persisted assistant message, once done
+        self.error = None
+        self.done = False
+        self.created = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def publish(self, chunk):
+        with self._lock:
+            self.chunks.append(chunk)
+
+    def finish(self, message=None, error=None):
+        with self._lock:
+            self.message = message
+            self.error = error
+            self.finished = time.time()
+            self.done = True
+
+    def snapshot(self):
+        """The reply text buffered so far."""
+        with self._lock:
+            return "".join(self.chunks)
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_slots = (None, None)  # (loop, semaphore): the semaphore belongs to the loop it runs on
+
+
+def _prune():
+    cutoff = time.time() - GENERATION_JOB_TTL
+    with _jobs_lock:
+        for job_id in [j.id for j in _jobs.values() if j.done and j.finished < cutoff]:
+            del _jobs[job_id]
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def active_job(email, conversation_id):
+    """The newest unfinished job for a conversation, if any."""
+    with _jobs_lock:
+        jobs = [j for j in _jobs.values()
+                if j.email == email and j.conversation_id == conversation_id and not j.done]
+    return max(jobs, key=lambda j: j.created, default=None)
+
+
+def _persist(job, text):
+    message = {
+        "role": "assistant",
+        "content": text,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    saved = conversation_store.append_message(job.email, job.conversation_id, message)
+    if saved is None:
+        logger.warning("Conversation %s is gone; reply not saved", job.conversation_id)
+        return message
+    position, entry = saved
+    try:
+        search_index.index_conversation(job.email, job.conversation_id, entry["file"], [message], offset=position)
+    except Exception as e:
+        logger.warning("Failed to index conversation %s: %s", job.conversation_id, error_text(e))
+    return message
+
+
+async def _run(job, agent, input, name, history, request_id):
+    global _slots
+    loop = asyncio.get_running_loop()
+    if _slots[0] is not loop:
+        _slots = (loop, asyncio.Semaphore(GENERATION_WORKERS))
+    queued = time.perf_counter()
+    async with _slots[1]:
+        QUEUE_SECONDS.observe(time.perf_counter() - queued)
+        try:
+            result = Runner.run_streamed(agent, input, name, history=history,
+                                         conversation_id=job.conversation_id, request_id=request_id)
+            async for event in result.stream_events():
+                job.publish(ItemHelpers.text_message_output(event.item))
+            text = job.snapshot()
+            message = await asyncio.to_thread(_persist, job, text) if text else None
+        except Exception as e:
+            logger.exception("Generation job %s failed: %s", job.id, e, extra={"request_id": request_id})
+            JOBS.inc(outcome="error")
+            job.finish(error=e)
+            return
+        except BaseException as e:
+            job.finish(error=e)  # cancelled with the loop: stop pollers waiting on it
+            raise
+    JOBS.inc(outcome="ok" if message else "empty")
+    job.finish(message)
+
+
+def submit(agent, input, name, email, conversation_id, history=None, request_id=None):
+    """Start generating a reply in the background and return its Job."""
+    _prune()
+    job = Job(email, conversation_id)
+    with _jobs_lock:
+        _jobs[job.id] = job
+    asyncio.run_coroutine_threadsafe(
+        _run(job, agent, input, name, list(history or []), request_id), openai_client.get_loop())
+    logger.info("Submitted generation job %s for conversation %s", job.id, conversation_id,
+                extra={"request_id": request_id})
+    return job
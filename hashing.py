@@ -0,0 +1,210 @@
+# hashing.py
+"""bcrypt hashing on a bounded process pool with admission control.
+
+A bcrypt call costs ~250 ms of CPU at the default work factor. Running it on
+Streamlit's script threads lets a burst of logins starve every session, so
+hashes run on a process pool sized to the cores. Once HASH_QUEUE_LIMIT
+requests are waiting, new ones fail fast with HashingBusy instead of queueing
+without bound.
+
+The work factor is BCRYPT_ROUNDS; run `python hashing.py --target-ms 100` to
+measure this machine and get a recommendation.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from bcrypt import checkpw, gensalt, hashpw
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", str(max(WORKERS, 1) * 4)))
+LATENCY_WINDOW = 1000
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+
+HASH_SECONDS = metrics.histogram("jokebot_bcrypt_seconds", "bcrypt time including queueing for a worker", ["op"])
+HASH_REJECTED = metrics.counter("jokebot_bcrypt_rejected_total", "Hash requests rejected with HashingBusy")
+HASH_IN_FLIGHT = metrics.gauge("jokebot_bcrypt_in_flight", "Hash requests running or waiting for a worker")
+HASH_QUEUE_DEPTH = metrics.gauge("jokebot_bcrypt_queue_depth", "Hash requests waiting for a worker")
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full; the caller should ask the user to retry."""
+
+
+def _hash(password, rounds):
+    return hashpw(password, gensalt(rounds))
+
+
+def _verify(password, hashed):
+    return checkpw(password, hashed)
+
+
+_lock = threading.Lock()
+_executor = None
+_in_flight = 0
+_stats = {"submitted": 0, "rejected": 0, "completed": 0}
+_latencies = deque(maxlen=LATENCY_WINDOW)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None and WORKERS > 0:
+        # spawn, not fork: the Streamlit server process is multi-threaded.
+        _executor = ProcessPoolExecutor(max_workers=WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def _submit(fn, *args):
+    """Run fn on the pool. A pool broken by a dead worker (OOM kill, crash) is
+    replaced and the call retried once before giving up with HashingBusy."""
+    for _ in range(2):
+        with _lock:
+            executor = _get_executor()
+        if executor is None:
+            return fn(*args)
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            logger.warning("Hash worker pool broke; starting a new one")
+            _discard_executor(executor)
+    raise HashingBusy("Password hashing is unavailable, please retry shortly.")
+
+
+def _discard_executor(executor):
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _set_depth():
+    # Called with _lock held.
+    HASH_IN_FLIGHT.set(_in_flight)
+    HASH_QUEUE_DEPTH.set(max(0, _in_flight - max(WORKERS, 1)))
+
+
+def _run(fn, *args):
+    global _in_flight
+    with _lock:
+        if _in_flight >= max(WORKERS, 1) + QUEUE_LIMIT:
+            _stats["rejected"] += 1
+            HASH_REJECTED.inc()
+            raise HashingBusy("Password hashing is busy, please retry shortly.")
+        _in_flight += 1
+        _stats["submitted"] += 1
+        _set_depth()
+    start = time.perf_counter()
+    try:
+        return _submit(fn, *args)
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _in_flight -= 1
+            _stats["completed"] += 1
+            _set_depth()
+            _latencies.append(elapsed)
+        HASH_SECONDS.observe(elapsed, op=fn.__name__.lstrip("_"))
+
+
+def hash_password(password, rounds=None):
+    """Return a bcrypt hash of `password` (str), computed off the calling thread."""
+    return _run(_hash, password.encode(), rounds or BCRYPT_ROUNDS)
+
+
+def verify_password(password, hashed):
+    """Check `password` (str) against a stored bcrypt hash."""
+    if isinstance(hashed, str):
+        hashed = hashed.encode()
+    return _run(_verify, password.encode(), hashed)
+
+
+def hash_rounds(hashed):
+    """Work factor encoded in a bcrypt hash ("$2b$12$..." -> 12), or None if unparseable."""
+    if isinstance(hashed, bytes):
+        hashed = hashed.decode("ascii", "replace")
+    parts = hashed.split("$")
+    try:
+        return int(parts[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(hashed):
+    return hash_rounds(hashed) != BCRYPT_ROUNDS
+
+
+def calibrate(target_ms, samples=3):
+    """Time bcrypt at increasing cost on this machine.
+
+    Returns (recommended_rounds, [(rounds, ms), ...]); the recommendation is the
+    highest cost whose median hash time stays within target_ms.
+    """
+    results = []
+    recommended = MIN_ROUNDS
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        salt = gensalt(rounds)
+        timings = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            hashpw(b"calibration-password", salt)
+            timings.append((time.perf_counter() - start) * 1000)
+        ms = sorted(timings)[len(timings) // 2]
+        results.append((rounds, ms))
+        if ms <= target_ms:
+            recommended = rounds
+        else:
+            break
+    return recommended, results
+
+
+def stats():
+    """Snapshot of queue depth and hash latency (seconds) for monitoring."""
+    with _lock:
+        latencies = sorted(_latencies)
+        snapshot = dict(_stats)
+        snapshot["in_flight"] = _in_flight
+        snapshot["queue_depth"] = max(0, _in_flight - max(WORKERS, 1))
+    snapshot["workers"] = WORKERS
+    snapshot["queue_limit"] = QUEUE_LIMIT
+    if latencies:
+        snapshot["latency_p50"] = latencies[len(latencies) // 2]
+        snapshot["latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        snapshot["latency_max"] = latencies[-1]
+    return snapshot
+
+
+def shutdown():
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommend a bcrypt work factor for this machine")
+    parser.add_argument("--target-ms", type=float, default=100, help="target hash latency in milliseconds")
+    args = parser.parse_args()
+
+    recommended, results = calibrate(args.target_ms)
+    for rounds, ms in results:
+        print(f"rounds={rounds:>2}  {ms:8.1f} ms")
+    print(f"Recommended: BCRYPT_ROUNDS={recommended} (target {args.target_ms:g} ms, current {BCRYPT_ROUNDS})")
+
+
+if __name__ == "__main__":
+    main()
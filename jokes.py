@@ -0,0 +1,101 @@
+# jokes.py
+"""Local answers for common mood prompts ("I'm sad", "so bored", "tell me a joke").
+
+The corpus in joke_corpus.json is indexed once per process into a phrase
+index: first token -> [(phrase tokens, mood)]. Matching is one pass over the
+input tokens with dictionary lookups, so a confident match is answered in
+microseconds without a network call. Anything ambiguous, negated or long
+goes to the model as before.
+"""
+import json
+import os
+import random
+import re
+import threading
+
+CORPUS_PATH = os.getenv("JOKE_CORPUS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "joke_corpus.json"))
+LOCAL_JOKES = os.getenv("LOCAL_JOKES", "1") == "1"
+MAX_WORDS = int(os.getenv("LOCAL_JOKES_MAX_WORDS", "8"))
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_NEGATIONS = {"not", "never", "no", "isnt", "arent", "wasnt", "dont", "didnt", "aint", "nt"}
+# Words that carry no intent; they don't count against match confidence.
+_FILLER = {
+    "i", "im", "am", "so", "very", "really", "feel", "feeling", "today", "right", "now",
+    "kinda", "bit", "a", "little", "super", "just", "pretty", "too", "and", "me", "please",
+    "m", "s", "is", "its", "it", "this", "that", "quite", "bot", "jokebot", "hey", "hi", "ugh",
+}
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower().replace("'", "").replace("’", ""))
+
+
+class JokeIndex:
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self.phrases = {}
+        for mood, entry in corpus.items():
+            for keyword in entry["keywords"]:
+                tokens = tuple(tokenize(keyword))
+                if tokens:
+                    self.phrases.setdefault(tokens[0], []).append((tokens, mood))
+        for candidates in self.phrases.values():
+            candidates.sort(key=lambda c: len(c[0]), reverse=True)  # longest phrase wins
+
+    @classmethod
+    def load(cls, path=CORPUS_PATH):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def match(self, text, max_words=MAX_WORDS):
+        """Return the mood for a confident match, or None."""
+        tokens = tokenize(text)
+        if not tokens or len(tokens) > max_words:
+            return None
+        moods = set()
+        covered = 0
+        i = 0
+        while i < len(tokens):
+            for phrase, mood in self.phrases.get(tokens[i], ()):
+                if tuple(tokens[i:i + len(phrase)]) == phrase:
+                    if i and tokens[i - 1] in _NEGATIONS:
+                        return None
+                    moods.add(mood)
+                    covered += len(phrase)
+                    i += len(phrase)
+                    break
+            else:
+                if tokens[i] not in _FILLER:
+                    return None  # an unexplained content word: let the model handle it
+                covered += 1
+                i += 1
+        if len(moods) != 1 or covered != len(tokens):
+            return None
+        return moods.pop()
+
+    def reply(self, mood, name, rng=random):
+        entry = self.corpus[mood]
+        return f"{rng.choice(entry['openers'])} {name}, here's one for you: {rng.choice(entry['jokes'])}"
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The process-wide index, built on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = JokeIndex.load()
+        return _index
+
+
+def local_reply(text, name):
+    """A local joke reply for a confident mood match, else None."""
+    if not LOCAL_JOKES:
+        return None
+    index = get_index()
+    mood = index.match(text)
+    return index.reply(mood, name) if mood else None
@@ -0,0 +1,312 @@
+# metrics.py
+"""In-process counters, gauges and histograms with Prometheus text export.
+
+Modules declare their metrics once at import time:
+
+    DB_QUERY_SECONDS = metrics.histogram("jokebot_db_query_seconds", "SQLite query time", ["op"])
+    with DB_QUERY_SECONDS.time(op="query_one"):
+        ...
+
+With METRICS_ENABLED=0 every observe/inc/set returns immediately and time()
+hands back a shared no-op context, so instrumented code pays one attribute
+check. render() produces the Prometheus text format; start_exporters()
+serves it on METRICS_PORT (/metrics) and/or rewrites METRICS_FILE every
+METRICS_DUMP_INTERVAL seconds for a node_exporter textfile collector.
+"""
+import bisect
+import contextlib
+import functools
+import logging
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the HTTP endpoint
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "15"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_NOOP = contextlib.nullcontext()
+_registry = {}
+_registry_lock = threading.Lock()
+_exporters_started = False
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _label_text(self, key, extra=None):
+        pairs = list(zip(self.labels, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in pairs) + "}"
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        return [f"{self.name}{self._label_text(key)} {_number(value)}" for key, value in sorted(self.snapshot().items())]
+
+
+class Gauge(Counter):
+    """A value that goes up and down, e.g. the current queue depth."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        """Context manager observing the elapsed seconds of its block."""
+        if not METRICS_ENABLED:
+            return _NOOP
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        """{label key: {"count", "sum", "p50", "p95", "p99"}} with quantiles estimated from buckets."""
+        with self._lock:
+            values = {key: ([*entry[0]], entry[1], entry[2]) for key, entry in self._values.items()}
+        return {key: {"count": count, "sum": total,
+                      "p50": self._quantile(counts, count, 0.5),
+                      "p95": self._quantile(counts, count, 0.95),
+                      "p99": self._quantile(counts, count, 0.99)}
+                for key, (counts, total, count) in values.items()}
+
+    def _quantile(self, counts, count, q):
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower  # overflow bucket: report its lower bound
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def render(self):
+        lines = []
+        with self._lock:
+            values = {key: ([*entry[0]], entry[1], entry[2]) for key, entry in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                le = "+Inf" if bound == math.inf else _number(bound)
+                lines.append(f"{self.name}_bucket{self._label_text(key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def timed(histogram, **labels):
+    """Decorator form of histogram.time()."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not METRICS_ENABLED:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorate
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        elif type(metric) is not cls:
+            raise ValueError(f"metric {name} already registered as a {metric.kind}")
+        return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter, name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return _register(Gauge, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help, labels, buckets)
+
+
+def all_metrics():
+    with _registry_lock:
+        return sorted(_registry.values(), key=lambda m: m.name)
+
+
+def summary_rows():
+    """One row per metric and label set, for the admin page. Latencies in ms."""
+    rows = []
+    for metric in all_metrics():
+        for key, value in sorted(metric.snapshot().items()):
+            row = {"metric": metric.name, "labels": ", ".join(f"{l}={v}" for l, v in zip(metric.labels, key))}
+            if isinstance(metric, Histogram):
+                scale = 1000 if metric.name.endswith("_seconds") else 1
+                row["count"] = value["count"]
+                for q in ("p50", "p95", "p99"):
+                    row[q] = round(value[q] * scale, 2) if value[q] is not None else None
+                row["mean"] = round(value["sum"] / value["count"] * scale, 2) if value["count"] else None
+            elif isinstance(metric, Gauge):
+                row["value"] = value
+            else:
+                row["count"] = value
+            rows.append(row)
+    return rows
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in all_metrics():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """Atomically write render() to `path`."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_exporters(port=None, path=None, interval=None):
+    """Start the /metrics endpoint and/or the file dump thread once per process."""
+    global _exporters_started
+    port = METRICS_PORT if port is None else port
+    path = METRICS_FILE if path is None else path
+    interval = interval or METRICS_DUMP_INTERVAL
+    with _registry_lock:
+        if _exporters_started or not METRICS_ENABLED:
+            return
+        _exporters_started = True
+    if port:
+        try:
+            server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+        except OSError as e:
+            logger.warning("Could not serve metrics on port %d: %s", port, e)
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            logger.info("Serving metrics on :%d/metrics", port)
+    if path:
+        def loop():
+            while True:
+                try:
+                    dump(path)
+                except OSError as e:
+                    logger.warning("Could not write metrics to %s: %s", path, e)
+                time.sleep(interval)
+        threading.Thread(target=loop, name="metrics-dump", daemon=True).start()
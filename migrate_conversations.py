@@ -0,0 +1,37 @@
+# migrate_conversations.py
+"""Convert legacy .json conversation files to the append-only JSON Lines format.
+
+Usage: python migrate_conversations.py [--email EMAIL]
+"""
+import argparse
+import logging
+import os
+
+import conversation_store
+
+SUFFIX = "_conversations"
+
+
+def all_users():
+    try:
+        names = os.listdir(conversation_store.USER_DATA_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(n[:-len(SUFFIX)] for n in names if n.endswith(SUFFIX))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--email", help="migrate a single user instead of everyone")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    users = [args.email] if args.email else all_users()
+    total = 0
+    for email in users:
+        total += conversation_store.migrate_to_jsonl(email)
+    print(f"Migrated {total} conversations for {len(users)} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# openai_client.py
+"""Process-wide AsyncOpenAI client hosted on one long-lived event loop.
+
+Streamlit re-runs the script on every interaction; building a client and an
+event loop per reply costs a new connection pool and TLS handshake each time.
+Work is instead submitted to a background loop that owns a single pooled
+client for the lifetime of the process.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import threading
+
+import httpx
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+REQUEST_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+
+_lock = threading.Lock()
+_loop = None
+_thread = None
+_clients = {}
+
+
+def get_loop():
+    """Return the shared background event loop, starting it on first use."""
+    global _loop, _thread
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(target=_loop.run_forever, name="openai-loop", daemon=True)
+            _thread.start()
+            logger.info("Started shared OpenAI event loop")
+        return _loop
+
+
+def get_client(api_key, base_url=None):
+    """Return the pooled AsyncOpenAI client for this key, creating it once."""
+    key = (api_key, base_url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT),
+            )
+            # Retries are handled by resilience.py, which knows about first-token
+            # deadlines and the circuit breaker; the SDK's own would stack on top.
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                                 max_retries=0)
+            _clients[key] = client
+        return client
+
+
+def run(coro):
+    """Run a coroutine on the shared loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def iterate(agen):
+    """Drive an async generator on the shared loop from synchronous code.
+
+    Each item is yielded in the calling thread, so Streamlit elements can be
+    updated from the script thread while the network I/O stays on the loop.
+    """
+    loop = get_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
+
+
+def shutdown():
+    """Close pooled connections and stop the background loop."""
+    global _loop, _thread
+    with _lock:
+        loop, thread, clients = _loop, _thread, list(_clients.values())
+        _clients.clear()
+        _loop = _thread = None
+    if loop is None or loop.is_closed():
+        return
+
+    async def close_clients():
+        for client in clients:
+            await client.close()
+
+    try:
+        asyncio.run_coroutine_threadsafe(close_clients(), loop).result(timeout=5)
+    except Exception as e:
+        logger.warning("Error closing OpenAI clients: %s", e)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    loop.close()
+    logger.info("Stopped shared OpenAI event loop")
+
+
+atexit.register(shutdown)
@@ -1,47 +1,367 @@
 # otp_sender.py
+import logging
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import os
 
+import db
+import metrics
+from log_config import mask_email
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
 API_KEY = os.getenv("MAILER_SEND_API_KEY")
 SENDER_EMAIL = os.getenv("MAILER_SEND_SENDER")
+MAILER_SEND_URL = os.getenv("MAILER_SEND_URL", "https://api.mailersend.com/v1/email")
+MAILER_SEND_BULK_URL = os.getenv("MAILER_SEND_BULK_URL", "https://api.mailersend.com/v1/bulk-email")
+
+CONNECT_TIMEOUT = float(os.getenv("MAILER_SEND_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.getenv("MAILER_SEND_READ_TIMEOUT", "10"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "1"))
+BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+BATCH_SIZE = 20
+
+# "single" posts each message to /v1/email; "bulk" collects due messages for
+# up to BULK_WINDOW seconds (or BULK_MAX recipients) and submits them as one
+# /v1/bulk-email request, then polls the bulk status for per-message results.
+OUTBOX_MODE = os.getenv("OUTBOX_MODE", "single")
+BULK_WINDOW = float(os.getenv("OUTBOX_BULK_WINDOW", "0.5"))
+BULK_MAX = int(os.getenv("OUTBOX_BULK_MAX", "500"))
+# A submitted batch whose status hasn't resolved after this long is marked failed.
+BULK_STATUS_TIMEOUT = float(os.getenv("OUTBOX_BULK_STATUS_TIMEOUT", "3600"))
+
+# Outbox row states
+PENDING = "pending"
+SENDING = "sending"
+SUBMITTED = "submitted"  # accepted by the bulk endpoint, awaiting its status
+SENT = "sent"
+FAILED = "failed"
+
+SEND_SECONDS = metrics.histogram("jokebot_otp_send_seconds", "MailerSend request time", ["mode"])
+SEND_OUTCOMES = metrics.counter("jokebot_otp_send_total", "OTP email delivery attempts by outcome", ["outcome"])
+
+_session = None
+_sender = None
+_wakeup = threading.Event()
+_lock = threading.Lock()
+
+def _get_session():
+    """One keep-alive session shared by the sender thread."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        _session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        _session.headers.update({
+            "Authorization": f"Bearer {API_KEY}",
+            "Content-Type": "application/json"
+        })
+    return _session
+
+# ─── OUTBOX ───
+def enqueue_email(email, subject, text):
+    """Queue a message for delivery and return its outbox id. A still-pending
+    message to the same recipient is replaced rather than sent twice."""
+    now = time.time()
+    with db.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        updated = conn.execute(
+            "UPDATE email_outbox SET subject = ?, body = ?, attempts = 0, next_attempt_at = ?, last_error = NULL "
+            "WHERE recipient = ? AND status = ?",
+            (subject, text, now, email, PENDING)).rowcount
+        if updated:
+            msg_id = conn.execute("SELECT MAX(id) FROM email_outbox WHERE recipient = ? AND status = ?",
+                                  (email, PENDING)).fetchone()[0]
+        else:
+            msg_id = conn.execute(
+                "INSERT INTO email_outbox (recipient, subject, body, status, attempts, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, 0, ?, ?)",
+                (email, subject, text, PENDING, now, now)).lastrowid
+    _wakeup.set()
+    return msg_id
+
+def send_otp_emails(pairs):
+    """Queue OTP emails for a list of (email, code) pairs.
+
+    Returns the outbox ids in the same order; pass one to outbox_status() to
+    follow that message.
+    """
+    if not API_KEY or not SENDER_EMAIL:
+        logger.error("MAILER_SEND_API_KEY or MAILER_SEND_SENDER not set in .env file")
+        return []
+
+    db.init_db()
+    ids = [enqueue_email(email, "🔐 Your OTP Code", f"Your OTP is: {code}") for email, code in pairs]
+    start_sender()
+    return ids
+
+def message_status(email):
+    """Latest outbox state for a recipient: pending, sending, submitted, sent or failed."""
+    row = db.query_one("SELECT status FROM email_outbox WHERE recipient = ? ORDER BY id DESC LIMIT 1", (email,))
+    return row[0] if row else None
+
+def outbox_status(msg_id):
+    """State of one outbox message by id, or None if there is no such message."""
+    row = db.query_one("SELECT status FROM email_outbox WHERE id = ?", (msg_id,))
+    return row[0] if row else None
 
 def send_otp_email(email, code):
     if not API_KEY or not SENDER_EMAIL:
-        print("❌ Error: MAILER_SEND_API_KEY or MAILER_SEND_SENDER not set in .env file")
+        logger.error("MAILER_SEND_API_KEY or MAILER_SEND_SENDER not set in .env file")
         return False
 
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
+    try:
+        db.init_db()
+        enqueue_email(email, "🔐 Your OTP Code", f"Your OTP is: {code}")
+        start_sender()
+        logger.info("OTP queued for %s", mask_email(email))
+        return True
+    except Exception as e:
+        logger.exception("Failed to queue OTP for %s: %s", mask_email(email), e)
+        return False
 
-    data = {
+def _backoff(attempts, retry_after=None):
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX)
+    delay = min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+def _retry_after(res):
+    try:
+        return float(res.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def _payload(recipient, subject, body):
+    return {
         "from": {
             "email": SENDER_EMAIL,
             "name": "JokeBot"
         },
-        "to": [{"email": email}],
-        "subject": "🔐 Your OTP Code",
-        "text": f"Your OTP is: {code}"
+        "to": [{"email": recipient}],
+        "subject": subject,
+        "text": body
     }
 
+def _deliver(row):
+    """POST one message. Returns (status, error, retry_after)."""
+    msg_id, recipient, subject, body = row
+    data = _payload(recipient, subject, body)
+    try:
+        with SEND_SECONDS.time(mode="single"):
+            res = _get_session().post(MAILER_SEND_URL, json=data, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.RequestException as e:
+        return PENDING, str(e), None
+    if res.status_code == 202:
+        return SENT, None, None
+    error = f"Status={res.status_code}, Response={res.text[:500]}"
+    if res.status_code == 429 or res.status_code >= 500:
+        return PENDING, error, _retry_after(res)
+    return FAILED, error, None
+
+def _deliver_bulk(rows):
+    """POST a batch to the bulk endpoint. Returns (status, error, retry_after, bulk_id)."""
+    data = [_payload(recipient, subject, body) for _, recipient, subject, body in rows]
     try:
-        res = requests.post("https://api.mailersend.com/v1/email", headers=headers, json=data)
-        if res.status_code == 202:
-            print(f"✅ OTP sent successfully to {email}")
-            return True
+        with SEND_SECONDS.time(mode="bulk"):
+            res = _get_session().post(MAILER_SEND_BULK_URL, json=data, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.RequestException as e:
+        return PENDING, str(e), None, None
+    if res.status_code == 202:
+        try:
+            return SUBMITTED, None, None, res.json()["bulk_email_id"]
+        except (ValueError, KeyError) as e:
+            return PENDING, f"Unreadable bulk response: {e}", None, None
+    error = f"Status={res.status_code}, Response={res.text[:500]}"
+    if res.status_code == 429 or res.status_code >= 500:
+        return PENDING, error, _retry_after(res), None
+    return FAILED, error, None, None
+
+def _failed_indexes(data):
+    """Message positions MailerSend rejected, from keys like "message.3.to.0.email"."""
+    failed = set()
+    for key in (data.get("validation_errors") or {}):
+        parts = key.split(".")
+        if len(parts) > 1 and parts[0] == "message" and parts[1].isdigit():
+            failed.add(int(parts[1]))
+    for index in (data.get("suppressed_recipients") or {}):
+        if str(index).isdigit():
+            failed.add(int(index))
+    return failed
+
+def _poll_bulk():
+    """Resolve submitted bulk batches into per-message sent/failed states."""
+    # claimed_at is set just before the batch is submitted.
+    expired = db.execute(
+        "UPDATE email_outbox SET status = ?, last_error = ? WHERE status = ? AND claimed_at < ?",
+        (FAILED, "Bulk email status not resolved in time", SUBMITTED, time.time() - BULK_STATUS_TIMEOUT))
+    if expired:
+        SEND_OUTCOMES.inc(expired, outcome=FAILED)
+        logger.warning("Gave up on %d bulk emails whose status never resolved", expired)
+    rows = db.query_all("SELECT DISTINCT bulk_id FROM email_outbox WHERE status = ?", (SUBMITTED,))
+    for (bulk_id,) in rows:
+        try:
+            res = _get_session().get(f"{MAILER_SEND_BULK_URL}/{bulk_id}", timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.RequestException as e:
+            logger.warning("Could not poll bulk email %s: %s", bulk_id, e)
+            continue
+        if res.status_code == 404:
+            db.execute("UPDATE email_outbox SET status = ?, last_error = ? WHERE bulk_id = ? AND status = ?",
+                       (FAILED, "Bulk email not found", bulk_id, SUBMITTED))
+            continue
+        if res.status_code != 200:
+            continue
+        try:
+            data = res.json().get("data", {})
+        except ValueError as e:
+            logger.warning("Unreadable status for bulk email %s: %s", bulk_id, e)
+            continue
+        state = data.get("state")
+        if state not in ("completed", "failed"):
+            continue
+        failed = _failed_indexes(data) if state == "completed" else None
+        now = time.time()
+        with db.connection() as conn:
+            for msg_id, index in conn.execute(
+                    "SELECT id, bulk_index FROM email_outbox WHERE bulk_id = ? AND status = ?",
+                    (bulk_id, SUBMITTED)).fetchall():
+                if failed is not None and index not in failed:
+                    conn.execute("UPDATE email_outbox SET status = ?, sent_at = ? WHERE id = ?", (SENT, now, msg_id))
+                    SEND_OUTCOMES.inc(outcome=SENT)
+                else:
+                    SEND_OUTCOMES.inc(outcome=FAILED)
+                    conn.execute("UPDATE email_outbox SET status = ?, last_error = ? WHERE id = ?",
+                                 (FAILED, f"Bulk email {bulk_id} {state}", msg_id))
+
+def _bulk_ready():
+    """True once the oldest due message has waited BULK_WINDOW or BULK_MAX are due."""
+    now = time.time()
+    count, oldest = db.query_one(
+        "SELECT COUNT(*), MIN(next_attempt_at) FROM email_outbox WHERE status = ? AND next_attempt_at <= ?",
+        (PENDING, now))
+    return count >= BULK_MAX or (oldest is not None and oldest <= now - BULK_WINDOW)
+
+def _drain_bulk():
+    if not _bulk_ready():
+        return 0
+    rows = _claim_due(BULK_MAX)
+    if not rows:
+        return 0
+    status, error, retry_after, bulk_id = _deliver_bulk(rows)
+    if status == SUBMITTED:
+        with db.connection() as conn:
+            conn.executemany("UPDATE email_outbox SET status = ?, bulk_id = ?, bulk_index = ? WHERE id = ?",
+                             [(SUBMITTED, bulk_id, i, row[0]) for i, row in enumerate(rows)])
+        logger.info("Submitted %d emails as bulk request %s", len(rows), bulk_id)
+        SEND_OUTCOMES.inc(len(rows), outcome=SUBMITTED)
+    else:
+        for row in rows:
+            outcome = _record(row[0], status, error, retry_after)
+            SEND_OUTCOMES.inc(outcome="retry" if outcome == PENDING else outcome)
+        logger.warning("Bulk submit of %d emails failed: %s", len(rows), error)
+    return len(rows)
+
+def _claim_due(limit=BATCH_SIZE):
+    now = time.time()
+    with db.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT id, recipient, subject, body FROM email_outbox "
+            "WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+            (PENDING, now, limit)).fetchall()
+        conn.executemany("UPDATE email_outbox SET status = ?, attempts = attempts + 1, claimed_at = ? WHERE id = ?",
+                         [(SENDING, now, row[0]) for row in rows])
+    return rows
+
+def _record(msg_id, status, error, retry_after):
+    with db.connection() as conn:
+        attempts = conn.execute("SELECT attempts FROM email_outbox WHERE id = ?", (msg_id,)).fetchone()[0]
+        if status == PENDING and attempts >= MAX_ATTEMPTS:
+            status = FAILED
+        next_attempt = time.time() + _backoff(attempts, retry_after) if status == PENDING else None
+        conn.execute(
+            "UPDATE email_outbox SET status = ?, last_error = ?, next_attempt_at = COALESCE(?, next_attempt_at), "
+            "sent_at = CASE WHEN ? = 'sent' THEN ? ELSE sent_at END WHERE id = ?",
+            (status, error, next_attempt, status, time.time(), msg_id))
+    return status
+
+def drain_once():
+    """Deliver up to BATCH_SIZE due messages. Returns the number attempted."""
+    if OUTBOX_MODE == "bulk":
+        _poll_bulk()
+        return _drain_bulk()
+    attempted = 0
+    while attempted < BATCH_SIZE:
+        # Claim one message at a time: a claim taken up front for the whole
+        # batch would age past recover_stale()'s cutoff while earlier
+        # messages are still being delivered.
+        rows = _claim_due(1)
+        if not rows:
+            break
+        row = rows[0]
+        attempted += 1
+        status, error, retry_after = _deliver(row)
+        status = _record(row[0], status, error, retry_after)
+        SEND_OUTCOMES.inc(outcome="retry" if status == PENDING else status)
+        if status == SENT:
+            logger.info("OTP email %d sent to %s", row[0], mask_email(row[1]))
+        elif status == FAILED:
+            logger.error("Giving up on email %d to %s: %s", row[0], mask_email(row[1]), error)
         else:
-            print(f"❌ Error sending OTP to {email}: Status={res.status_code}, Response={res.text}")
-            try:
-                error_details = res.json()
-                print("Error Details:", error_details)
-            except:
-                print("No JSON response available.")
-            return False
-    except Exception as e:
-        print(f"❌ Exception while sending OTP to {email}: {str(e)}")
-        return False
\ No newline at end of file
+            logger.warning("Email %d to %s will be retried: %s", row[0], mask_email(row[1]), error)
+    return attempted
+
+def recover_stale():
+    """Return messages left in 'sending' by a crashed process to the queue.
+
+    A live sender holds a claim for at most one request (single mode claims
+    one message per request, bulk mode one batch per request), so resetting
+    only claims older than two full request timeouts never races it into a
+    duplicate delivery.
+    """
+    cutoff = time.time() - 2 * (CONNECT_TIMEOUT + READ_TIMEOUT)
+    return db.execute("UPDATE email_outbox SET status = ? WHERE status = ? AND claimed_at < ?",
+                      (PENDING, SENDING, cutoff))
+
+def _next_due_in():
+    row = db.query_one("SELECT MIN(next_attempt_at) FROM email_outbox WHERE status = ?", (PENDING,))
+    if row is None or row[0] is None:
+        return POLL_INTERVAL
+    due = row[0] + (BULK_WINDOW if OUTBOX_MODE == "bulk" else 0)
+    return max(0, min(due - time.time(), POLL_INTERVAL))
+
+def _sender_loop():
+    while True:
+        _wakeup.clear()
+        try:
+            recover_stale()
+            if drain_once() == (BULK_MAX if OUTBOX_MODE == "bulk" else BATCH_SIZE):
+                continue
+            timeout = _next_due_in()
+        except Exception as e:
+            logger.exception("Outbox sender error: %s", e)
+            timeout = POLL_INTERVAL
+        _wakeup.wait(timeout)
+
+def start_sender():
+    """Start the background outbox sender for this process (idempotent).
+
+    Called at app startup as well as on enqueue, so mail left in the outbox
+    by a crashed process goes out without waiting for the next OTP request.
+    """
+    global _sender
+    with _lock:
+        if _sender is not None and _sender.is_alive():
+            return
+        db.init_db()
+        _sender = threading.Thread(target=_sender_loop, name="otp-outbox", daemon=True)
+        _sender.start()
@@ -0,0 +1,159 @@
+# otp_store.py
+"""Password-reset OTP storage with expiry and attempt limits.
+
+Two backends share one interface: MemoryOTPStore for a single process, and
+SQLiteOTPStore, which keeps codes in users.db so any replica can verify a
+code another replica sent. Expired codes are removed by a background sweep.
+"""
+import hmac
+import logging
+import os
+import threading
+import time
+
+import db
+
+logger = logging.getLogger(__name__)
+
+OTP_TTL_SECONDS = int(os.getenv("OTP_TTL_SECONDS", "600"))
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
+OTP_SWEEP_INTERVAL = int(os.getenv("OTP_SWEEP_INTERVAL", "60"))
+OTP_STORE_BACKEND = os.getenv("OTP_STORE_BACKEND", "sqlite")
+
+# verify() results
+VERIFIED = "verified"
+INVALID = "invalid"
+EXPIRED = "expired"
+TOO_MANY_ATTEMPTS = "too_many_attempts"
+
+
+def _check(entry_code, expires_at, attempts, code, now, max_attempts):
+    """Shared verification rule; returns (result, keep_entry)."""
+    if expires_at <= now:
+        return EXPIRED, False
+    if attempts >= max_attempts:
+        return TOO_MANY_ATTEMPTS, False
+    if hmac.compare_digest(str(entry_code), str(code or "")):
+        return VERIFIED, True
+    if attempts + 1 >= max_attempts:
+        return TOO_MANY_ATTEMPTS, False
+    return INVALID, True
+
+
+class OTPStore:
+    def __init__(self, ttl=OTP_TTL_SECONDS, max_attempts=OTP_MAX_ATTEMPTS, clock=time.time):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self._sweeper = None
+
+    def put(self, email, code):
+        """Store a new code for `email`, replacing any earlier one."""
+        raise NotImplementedError
+
+    def verify(self, email, code):
+        """Check a code; returns VERIFIED, INVALID, EXPIRED or TOO_MANY_ATTEMPTS."""
+        raise NotImplementedError
+
+    def discard(self, email):
+        raise NotImplementedError
+
+    def sweep(self):
+        """Delete expired codes; returns the number removed."""
+        raise NotImplementedError
+
+    def start_sweeper(self, interval=OTP_SWEEP_INTERVAL):
+        if self._sweeper is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.exception("OTP sweep failed: %s", e)
+
+        self._sweeper = threading.Thread(target=loop, name="otp-sweeper", daemon=True)
+        self._sweeper.start()
+
+
+class MemoryOTPStore(OTPStore):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._codes = {}
+        self._lock = threading.Lock()
+
+    def put(self, email, code):
+        with self._lock:
+            self._codes[email] = [code, self.clock() + self.ttl, 0]
+
+    def verify(self, email, code):
+        with self._lock:
+            entry = self._codes.get(email)
+            if entry is None:
+                return INVALID
+            result, keep = _check(entry[0], entry[1], entry[2], code, self.clock(), self.max_attempts)
+            if not keep:
+                del self._codes[email]
+            elif result == INVALID:
+                entry[2] += 1
+            return result
+
+    def discard(self, email):
+        with self._lock:
+            self._codes.pop(email, None)
+
+    def sweep(self):
+        now = self.clock()
+        with self._lock:
+            expired = [email for email, entry in self._codes.items() if entry[1] <= now]
+            for email in expired:
+                del self._codes[email]
+        return len(expired)
+
+
+class SQLiteOTPStore(OTPStore):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        db.init_db()
+
+    def put(self, email, code):
+        db.execute(
+            "INSERT OR REPLACE INTO otp_codes (email, code, expires_at, attempts) VALUES (?, ?, ?, 0)",
+            (email, code, self.clock() + self.ttl),
+        )
+
+    def verify(self, email, code):
+        with db.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT code, expires_at, attempts FROM otp_codes WHERE email = ?",
+                               (email,)).fetchone()
+            if row is None:
+                return INVALID
+            result, keep = _check(row[0], row[1], row[2], code, self.clock(), self.max_attempts)
+            if not keep:
+                conn.execute("DELETE FROM otp_codes WHERE email = ?", (email,))
+            elif result == INVALID:
+                conn.execute("UPDATE otp_codes SET attempts = attempts + 1 WHERE email = ?", (email,))
+            return result
+
+    def discard(self, email):
+        db.execute("DELETE FROM otp_codes WHERE email = ?", (email,))
+
+    def sweep(self):
+        return db.execute("DELETE FROM otp_codes WHERE expires_at <= ?", (self.clock(),))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Process-wide store for the configured backend, with its sweeper running."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MemoryOTPStore() if OTP_STORE_BACKEND == "memory" else SQLiteOTPStore()
+            _store.start_sweeper()
+        return _store
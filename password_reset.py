@@ -1,12 +1,16 @@
 # password_reset.py
 import streamlit as st
+import logging
 import random
 import re
-import sqlite3
-from bcrypt import hashpw, gensalt
+from db import set_password_hash
+from hashing import hash_password
 from otp_sender import send_otp_email
+import otp_store
+import rate_limit
+from log_config import mask_email
 
-otp_store = {}
+logger = logging.getLogger(__name__)
 
 def is_valid_email(email):
     pattern = r'^[\w\.-]+@[\w\.-]+\.\w+$'
@@ -15,15 +19,12 @@ def is_valid_email(email):
 def update_password(email, new_password):
     """Update the user's password in the database."""
     try:
-        hashed = hashpw(new_password.encode(), gensalt())
-        conn = sqlite3.connect("users.db")
-        conn.execute("UPDATE users SET password_hash = ? WHERE email = ?", (hashed, email))
-        conn.commit()
-        conn.close()
-        print(f"✅ Password updated successfully for {email}")
+        hashed = hash_password(new_password)
+        set_password_hash(email, hashed)
+        logger.info("Password updated for %s", mask_email(email))
         return True
     except Exception as e:
-        print(f"❌ Error updating password for {email}: {str(e)}")
+        logger.error("Error updating password for %s: %s", mask_email(email), e)
         return False
 
 def reset_password_ui():
@@ -35,13 +36,14 @@ def reset_password_ui():
         if not is_valid_email(email):
             st.error("❌ Please enter a valid email address.")
             return
-        print(f"Attempting to send OTP to {email}")  # Debug
+        if not rate_limit.allow("otp_send", email, st.session_state):
+            st.error("🚦 Too many attempts. Please wait a moment and try again.")
+            return
         otp = str(random.randint(100000, 999999))
-        otp_store[email] = otp
+        otp_store.get_store().put(email, otp)
         success = send_otp_email(email, otp)
-        print(f"Send OTP result: {success}")  # Debug
+        logger.debug("Send OTP to %s: success=%s", mask_email(email), success)
         if success:
-            print("Setting session state to verify")  # Debug
             st.success("✅ OTP sent to your email.")
             st.session_state.email_for_reset = email
             st.session_state.step = "verify"
@@ -54,15 +56,24 @@ def reset_password_ui():
         new_password = st.text_input("New Password", type="password")
 
         if st.button("Reset Password"):
-            if otp_store.get(st.session_state.email_for_reset) == entered_otp:
+            if not rate_limit.allow("otp_verify", st.session_state.email_for_reset, st.session_state):
+                st.error("🚦 Too many attempts. Please wait a moment and try again.")
+                return
+            store = otp_store.get_store()
+            result = store.verify(st.session_state.email_for_reset, entered_otp)
+            if result == otp_store.VERIFIED:
                 success = update_password(st.session_state.email_for_reset, new_password)
                 if success:
                     st.success("✅ Password reset successful!")
                     st.session_state.step = None
                     st.session_state.show_reset_password = False
-                    del otp_store[st.session_state.email_for_reset]  
+                    store.discard(st.session_state.email_for_reset)
                     st.rerun()
                 else:
                     st.error("❌ Failed to update password. Please try again.")
+            elif result == otp_store.EXPIRED:
+                st.error("⌛ OTP expired. Please request a new one.")
+            elif result == otp_store.TOO_MANY_ATTEMPTS:
+                st.error("🚫 Too many incorrect attempts. Please request a new OTP.")
             else:
                 st.error("❌ Incorrect OTP.")
\ No newline at end of file
@@ -0,0 +1,164 @@
+# rate_limit.py
+"""Token-bucket rate limiting for login, signup and OTP actions.
+
+Each action has a bucket of `capacity` tokens refilled evenly over `period`
+seconds, configured as "capacity/period" (e.g. RATE_LIMIT_LOGIN="10/300").
+Buckets are keyed by email and by session; a request must find a token in
+every bucket it names. Rejections never reach bcrypt or the mail API and do
+not write to the database.
+"""
+import os
+import random
+import threading
+import time
+import uuid
+
+import db
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "sqlite")
+
+DEFAULT_LIMITS = {
+    "login": "10/300",
+    "signup": "5/3600",
+    "otp_send": "3/600",
+    "otp_verify": "10/600",
+}
+
+
+def parse_limit(spec):
+    capacity, period = spec.split("/")
+    return float(capacity), float(period)
+
+
+def load_limits():
+    return {
+        action: parse_limit(os.getenv(f"RATE_LIMIT_{action.upper()}", spec))
+        for action, spec in DEFAULT_LIMITS.items()
+    }
+
+
+def _refill(tokens, updated_at, capacity, period, now):
+    return min(capacity, tokens + (now - updated_at) * capacity / period)
+
+
+class RateLimiter:
+    def __init__(self, limits=None, clock=time.time):
+        self.limits = limits or load_limits()
+        self.clock = clock
+
+    def _keys(self, action, email, session):
+        keys = []
+        if email:
+            keys.append(f"{action}:email:{email.strip().lower()}")
+        if session:
+            keys.append(f"{action}:session:{session}")
+        return keys
+
+    def allow(self, action, email=None, session=None):
+        """Take one token from each of the action's buckets, or none if any is empty."""
+        if action not in self.limits:
+            return True
+        keys = self._keys(action, email, session)
+        if not keys:
+            return True
+        capacity, period = self.limits[action]
+        return self._take(keys, capacity, period, self.clock())
+
+    def _take(self, keys, capacity, period, now):
+        raise NotImplementedError
+
+    def _longest_period(self):
+        # A bucket idle this long has refilled under every limit, so it carries no state.
+        return max(period for _, period in self.limits.values())
+
+
+class MemoryRateLimiter(RateLimiter):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._swept_at = self.clock()
+
+    def _take(self, keys, capacity, period, now):
+        with self._lock:
+            if now - self._swept_at >= self._longest_period():
+                self._sweep(now)
+            levels = []
+            for key in keys:
+                tokens, updated_at = self._buckets.get(key, (capacity, now))
+                tokens = _refill(tokens, updated_at, capacity, period, now)
+                if tokens < 1:
+                    return False
+                levels.append(tokens)
+            for key, tokens in zip(keys, levels):
+                self._buckets[key] = (tokens - 1, now)
+            return True
+
+    def _sweep(self, now):
+        # Keys include client-chosen emails; without this the dict grows forever.
+        cutoff = now - self._longest_period()
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[1] >= cutoff}
+        self._swept_at = now
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """Buckets in users.db so limits hold across server processes."""
+    SWEEP_PROBABILITY = 0.01
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        db.init_db()
+
+    def _levels(self, conn, keys, capacity, period, now):
+        placeholders = ",".join("?" * len(keys))
+        rows = dict((row[0], row[1:]) for row in conn.execute(
+            f"SELECT key, tokens, updated_at FROM rate_limits WHERE key IN ({placeholders})", keys))
+        levels = []
+        for key in keys:
+            tokens, updated_at = rows.get(key, (capacity, now))
+            levels.append(_refill(tokens, updated_at, capacity, period, now))
+        return levels
+
+    def _take(self, keys, capacity, period, now):
+        with db.connection() as conn:
+            # Cheap read-only check first: an empty bucket is rejected without
+            # taking the write lock.
+            if min(self._levels(conn, keys, capacity, period, now)) < 1:
+                return False
+            conn.execute("BEGIN IMMEDIATE")
+            levels = self._levels(conn, keys, capacity, period, now)
+            if min(levels) < 1:
+                return False
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)",
+                [(key, tokens - 1, now) for key, tokens in zip(keys, levels)])
+            if random.random() < self.SWEEP_PROBABILITY:
+                self._sweep(conn, now)
+            return True
+
+    def _sweep(self, conn, now):
+        conn.execute("DELETE FROM rate_limits WHERE updated_at < ?", (now - self._longest_period(),))
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = MemoryRateLimiter() if RATE_LIMIT_BACKEND == "memory" else SQLiteRateLimiter()
+        return _limiter
+
+
+def session_key(session_state):
+    """Stable per-browser-session id kept in Streamlit session state."""
+    if "rate_limit_session" not in session_state:
+        session_state.rate_limit_session = uuid.uuid4().hex
+    return session_state.rate_limit_session
+
+
+def allow(action, email=None, session_state=None):
+    session = session_key(session_state) if session_state is not None else None
+    return get_limiter().allow(action, email=email, session=session)
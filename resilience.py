@@ -0,0 +1,235 @@
+# resilience.py
+"""Deadlines, retries, hedging and a circuit breaker for the upstream model stream.
+
+resilient_stream() wraps a function that opens one upstream text stream:
+
+- a first-token deadline bounds how long an attempt may wait for content,
+  and a total deadline bounds the whole reply;
+- retryable failures before the first token (connection errors, timeouts,
+  429, 5xx) are retried with full-jitter exponential backoff;
+- with hedging enabled, a second attempt starts if the first has produced
+  nothing after UPSTREAM_HEDGE_AFTER seconds, and whichever yields first wins;
+- consecutive failures open the circuit breaker, and while it is open calls
+  fail immediately with CircuitOpen so the caller can serve its fallback.
+
+Once a token has been yielded nothing is retried, since it is already on screen.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import httpx
+import openai
+
+FIRST_TOKEN_TIMEOUT = float(os.getenv("UPSTREAM_FIRST_TOKEN_TIMEOUT", "15"))
+TOTAL_TIMEOUT = float(os.getenv("UPSTREAM_TOTAL_TIMEOUT", "90"))
+MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.25"))
+RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "4"))
+HEDGE_AFTER = float(os.getenv("UPSTREAM_HEDGE_AFTER", "0"))  # 0 disables hedging
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_AFTER = float(os.getenv("BREAKER_RESET_AFTER", "30"))
+
+
+class FirstTokenTimeout(Exception):
+    pass
+
+
+class TotalTimeout(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+RETRYABLE = (
+    openai.APIConnectionError,   # includes APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+    httpx.TransportError,
+    asyncio.TimeoutError,
+    FirstTokenTimeout,
+)
+
+
+def is_retryable(exc):
+    return isinstance(exc, RETRYABLE)
+
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures; half-open after
+    `reset_after` seconds lets one trial call through."""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold=BREAKER_FAILURE_THRESHOLD, reset_after=BREAKER_RESET_AFTER, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_after:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+    def release(self):
+        """Give back a half-open trial that ended without a verdict (e.g. the caller went away)."""
+        with self._lock:
+            self._trial = False
+
+
+breaker = CircuitBreaker()
+
+
+class Policy:
+    """Deadlines and retry settings; unset fields use the module-level defaults."""
+    def __init__(self, first_token_timeout=None, total_timeout=None, max_retries=None,
+                 retry_base_delay=None, retry_max_delay=None, hedge_after=None):
+        pick = lambda value, default: default if value is None else value
+        self.first_token_timeout = pick(first_token_timeout, FIRST_TOKEN_TIMEOUT)
+        self.total_timeout = pick(total_timeout, TOTAL_TIMEOUT)
+        self.max_retries = pick(max_retries, MAX_RETRIES)
+        self.retry_base_delay = pick(retry_base_delay, RETRY_BASE_DELAY)
+        self.retry_max_delay = pick(retry_max_delay, RETRY_MAX_DELAY)
+        self.hedge_after = pick(hedge_after, HEDGE_AFTER)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * (2 ** attempt)))
+
+
+async def _close(stream):
+    try:
+        await stream.aclose()
+    except Exception:
+        pass
+
+
+async def _open_first(open_stream):
+    """Open one stream and wait for its first chunk: (first_chunk or None, stream)."""
+    stream = await open_stream()
+    try:
+        return await stream.__anext__(), stream
+    except StopAsyncIteration:
+        return None, stream
+    except BaseException:
+        await _close(stream)
+        raise
+
+
+async def _first_token(open_stream, policy, deadline):
+    """Race one attempt (plus a hedge, if enabled) to the first chunk."""
+    loop = asyncio.get_running_loop()
+    first_deadline = min(deadline, loop.time() + policy.first_token_timeout)
+    tasks = {asyncio.ensure_future(_open_first(open_stream))}
+    hedge_at = loop.time() + policy.hedge_after if policy.hedge_after else None
+    error = None
+    try:
+        while tasks:
+            wake = min(first_deadline, hedge_at) if hedge_at else first_deadline
+            done, _ = await asyncio.wait(tasks, timeout=max(0, wake - loop.time()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tasks.discard(task)
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if hedge_at and loop.time() >= hedge_at:
+                tasks.add(asyncio.ensure_future(_open_first(open_stream)))
+                hedge_at = None
+            if loop.time() >= first_deadline:
+                raise FirstTokenTimeout(f"no token within {policy.first_token_timeout:g}s")
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                _, stream = await task
+                await _close(stream)
+            except BaseException:
+                pass
+
+
+async def resilient_stream(open_stream, policy=None, circuit=None):
+    """Yield text chunks from `open_stream()` (an async function returning an
+    async iterator of strings) under the deadlines, retries, hedging and
+    circuit breaker described above."""
+    policy = policy or Policy()
+    circuit = circuit or breaker
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + policy.total_timeout
+
+    attempt = 0
+    while True:
+        if not circuit.allow():
+            raise CircuitOpen("upstream circuit is open")
+        try:
+            first, stream = await _first_token(open_stream, policy, deadline)
+            break
+        except Exception as e:
+            if not is_retryable(e):
+                circuit.release()
+                raise
+            circuit.record_failure()
+            delay = policy.backoff(attempt)
+            attempt += 1
+            if attempt > policy.max_retries or loop.time() + delay >= deadline:
+                raise
+            await asyncio.sleep(delay)
+
+    recorded = False
+    try:
+        if first is None:
+            circuit.record_success()
+            recorded = True
+            return
+        yield first
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TotalTimeout(f"reply exceeded {policy.total_timeout:g}s")
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), remaining)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise TotalTimeout(f"reply exceeded {policy.total_timeout:g}s")
+            yield chunk
+        circuit.record_success()
+        recorded = True
+    except (TotalTimeout, *RETRYABLE):
+        circuit.record_failure()
+        recorded = True
+        raise
+    finally:
+        if not recorded:
+            circuit.release()
+        await _close(stream)
@@ -0,0 +1,142 @@
+# response_cache.py
+"""Cache of completed model replies keyed on a normalized prompt.
+
+"I'm sad!", "im sad" and "  I’m   SAD " share one key, combined with the
+model and the personalization fields. Entries expire after a TTL and the
+least recently used are evicted past a size cap. MemoryResponseCache is per
+process; SQLiteResponseCache keeps entries in users.db for all workers.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import db
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")  # memory | sqlite | off
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+# "first_turn" only caches prompts that open a conversation, since later replies
+# depend on the history sent with them; "any" ignores history.
+RESPONSE_CACHE_SCOPE = os.getenv("RESPONSE_CACHE_SCOPE", "first_turn")
+
+_APOSTROPHES = re.compile(r"[’'`´]")
+_NON_WORD = re.compile(r"[^\w\s]", re.UNICODE)
+
+
+def normalize(text):
+    text = _APOSTROPHES.sub("", (text or "").lower())
+    text = _NON_WORD.sub(" ", text)
+    return " ".join(text.split())
+
+
+def cache_key(model, text, **fields):
+    payload = json.dumps([model, normalize(text), sorted(fields.items())], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key):
+        value = self._get(key)
+        with self._stats_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def stats(self):
+        with self._stats_lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+
+class MemoryResponseCache(ResponseCache):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteResponseCache(ResponseCache):
+    EVICT_EVERY = 100  # puts between eviction passes
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._puts = 0
+        db.init_db()
+
+    def _get(self, key):
+        now = self.clock()
+        row = db.query_one("SELECT response FROM response_cache WHERE key = ? AND expires_at > ?", (key, now))
+        if row is None:
+            return None
+        db.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key, value):
+        now = self.clock()
+        with db.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, response, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now))
+            self._puts += 1
+            if self._puts % self.EVICT_EVERY == 0:
+                conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+                conn.execute(
+                    "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache "
+                    "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide cache for the configured backend, or None when disabled."""
+    global _cache
+    if RESPONSE_CACHE_BACKEND == "off":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = SQLiteResponseCache() if RESPONSE_CACHE_BACKEND == "sqlite" else MemoryResponseCache()
+        return _cache
+
+
+def cacheable(history):
+    return RESPONSE_CACHE_SCOPE == "any" or not history
@@ -0,0 +1,189 @@
+# search_index.py
+"""Full-text search over a user's conversations, backed by SQLite FTS5.
+
+Every message is one row in the message_search table. search_progress
+records how many messages of each conversation are indexed, so saving a
+conversation only indexes the new tail (index_conversation) and the
+one-off build from existing files (build_user_index, or
+`python search_index.py` for every user) skips what is already done.
+
+Results are ranked by BM25 and grouped per conversation, best hit first.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import threading
+
+import conversation_store
+import db
+from log_config import error_text, mask_email
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "10"))
+SNIPPET_TOKENS = 12
+
+_QUERY_TERM = re.compile(r"\w+", re.UNICODE)
+
+_built = set()
+_built_lock = threading.Lock()
+
+
+def owner_token(email):
+    return "u" + hashlib.sha1(email.lower().encode("utf-8")).hexdigest()[:16]
+
+
+def match_expression(query):
+    """FTS5 query for free text: every word must match, the last one as a prefix."""
+    terms = _QUERY_TERM.findall(query or "")
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def _progress(conn, email, conv_id):
+    row = conn.execute("SELECT indexed_count FROM search_progress WHERE email = ? AND conversation_id = ?",
+                       (email, conv_id)).fetchone()
+    return row[0] if row else 0
+
+
+def _set_progress(conn, email, conv_id, count):
+    conn.execute("INSERT OR REPLACE INTO search_progress (email, conversation_id, indexed_count) VALUES (?, ?, ?)",
+                 (email, conv_id, count))
+
+
+def _insert(conn, email, conv_id, messages, start):
+    owner = owner_token(email)
+    conn.executemany(
+        "INSERT INTO message_search (content, owner, conversation_id, position, role) VALUES (?, ?, ?, ?, ?)",
+        [(m.get("content", ""), owner, conv_id, start + i, m.get("role", ""))
+         for i, m in enumerate(messages) if m.get("content")])
+
+
+def _delete(conn, email, conv_id=None):
+    owner = owner_token(email)
+    if conv_id is None:
+        conn.execute("DELETE FROM message_search WHERE owner = ?", (owner,))
+        conn.execute("DELETE FROM search_progress WHERE email = ?", (email,))
+    else:
+        conn.execute("DELETE FROM message_search WHERE owner = ? AND conversation_id = ?", (owner, conv_id))
+        conn.execute("DELETE FROM search_progress WHERE email = ? AND conversation_id = ?", (email, conv_id))
+
+
+def index_conversation(email, conv_id, file_path, messages=None, offset=0):
+    """Index the messages of a conversation that are not indexed yet.
+
+    `messages` is the in-memory window starting at position `offset` (as
+    passed to conversation_store.save_conversation); anything before the
+    window that is still unindexed is read from `file_path`. With no
+    `messages` the whole file is read. Returns the number of rows added.
+    """
+    db.init_db()
+    if messages is None:
+        messages, offset = conversation_store.read_messages(file_path), 0
+    total = offset + len(messages)
+    with db.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        indexed = _progress(conn, email, conv_id)
+        if indexed > total:
+            # The conversation shrank (rewritten elsewhere): start over.
+            _delete(conn, email, conv_id)
+            indexed = 0
+        if indexed < offset:
+            start, missing = conversation_store.read_window(file_path, offset - indexed, offset)
+            _insert(conn, email, conv_id, missing, start)
+            indexed = offset
+        new = messages[indexed - offset:]
+        _insert(conn, email, conv_id, new, indexed)
+        _set_progress(conn, email, conv_id, total)
+    return len(new)
+
+
+def remove_conversation(email, conv_id):
+    db.init_db()
+    with db.connection() as conn:
+        _delete(conn, email, conv_id)
+
+
+def remove_user(email):
+    db.init_db()
+    with db.connection() as conn:
+        _delete(conn, email)
+
+
+def build_user_index(email):
+    """Index whatever is missing from a user's conversation files. Runs once per user per process."""
+    with _built_lock:
+        if email in _built:
+            return 0
+    db.init_db()
+    indexed = dict(db.query_all("SELECT conversation_id, indexed_count FROM search_progress WHERE email = ?",
+                                (email,)))
+    added = 0
+    for entry in conversation_store.list_conversations(email):
+        if indexed.get(entry["id"], 0) == entry.get("message_count", 0):
+            continue
+        try:
+            added += index_conversation(email, entry["id"], entry["file"])
+        except (OSError, ValueError) as e:
+            logger.warning("Could not index conversation %s: %s", entry["id"], error_text(e))
+    with _built_lock:
+        _built.add(email)
+    if added:
+        logger.info("Indexed %d messages for user %s", added, mask_email(email))
+    return added
+
+
+def search(email, query, page=0, page_size=SEARCH_PAGE_SIZE):
+    """Conversations matching `query`, best first: (hits, has_more).
+
+    Each hit is {"id", "position", "role", "snippet", "score"} for the best
+    matching message of that conversation.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+    db.init_db()
+    # The CTE is materialized because FTS functions can't run inside an
+    # aggregate. Bare columns next to MIN() come from the row holding the
+    # minimum, so each conversation is represented by its best-ranked message.
+    rows = db.query_all(
+        "WITH hits AS MATERIALIZED ("
+        "  SELECT conversation_id, position, role, bm25(message_search, 1.0, 0.0) AS score,"
+        "         snippet(message_search, 0, '**', '**', '…', ?) AS snippet"
+        "  FROM message_search WHERE message_search MATCH ?"
+        ") SELECT conversation_id, position, role, snippet, MIN(score) AS best FROM hits"
+        " GROUP BY conversation_id ORDER BY best LIMIT ? OFFSET ?",
+        (SNIPPET_TOKENS, f"owner : {owner_token(email)} AND content : ({expression})",
+         page_size + 1, page * page_size))
+    hits = [{"id": r[0], "position": r[1], "role": r[2], "snippet": r[3], "score": r[4]}
+            for r in rows[:page_size]]
+    return hits, len(rows) > page_size
+
+
+def build_all(user_data_dir=None):
+    """Index every user's conversations under user_data_dir. Returns the number of messages added."""
+    user_data_dir = user_data_dir or conversation_store.USER_DATA_DIR
+    suffix = "_conversations"
+    added = 0
+    for name in sorted(os.listdir(user_data_dir)):
+        if name.endswith(suffix) and os.path.isdir(os.path.join(user_data_dir, name)):
+            added += build_user_index(name[:-len(suffix)])
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the conversation search index from existing files")
+    parser.add_argument("--email", help="only index this user")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    added = build_user_index(args.email) if args.email else build_all()
+    print(f"Indexed {added} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# singleflight.py
+"""Share one upstream completion between concurrent identical requests.
+
+The first request for a key starts the upstream stream as a background task
+(the leader); requests for the same key that arrive while it is running
+subscribe to it instead of opening their own. Every subscriber gets its own
+async iterator that replays the chunks buffered so far and then follows the
+live tail. The leader runs to completion even if subscribers go away, so the
+response cache is still filled.
+"""
+import asyncio
+import os
+import threading
+
+SINGLEFLIGHT = os.getenv("SINGLEFLIGHT", "1") == "1"
+
+
+class _Flight:
+    def __init__(self, loop):
+        self.loop = loop
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _wake(self):
+        # Swap in a fresh event so the next wait blocks until the next change.
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, error=None):
+        self.error = error
+        self.done = True
+        self._wake()
+
+    async def follow(self):
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    async def stream(self, key, factory):
+        """Yield the chunks of `factory()` (an async generator function), shared per key."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.done or flight.loop is not loop:
+                flight = _Flight(loop)
+                self._flights[key] = flight
+                flight.task = loop.create_task(self._run(key, flight, factory))
+                self.leaders += 1
+            else:
+                self.followers += 1
+        async for chunk in flight.follow():
+            yield chunk
+
+    async def _run(self, key, flight, factory):
+        error = None
+        try:
+            async for chunk in factory():
+                flight.publish(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.finish(error)
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)}
+
+
+group = SingleFlight()
@@ -1,17 +1,28 @@
 import streamlit as st
-import asyncio
+import heapq
 import json
 import os
 import random
+import sqlite3
 from datetime import datetime
-from agents import Agent, Runner, ItemHelpers
+from agents import Agent, ModelRouter, JOKEBOT_INSTRUCTIONS
+import generation
 from db import init_db, register_user, authenticate_user
+import hashing
+from hashing import HashingBusy
+import rate_limit
+import conversation_store
+import search_index
+import metrics
+import otp_sender
 from password_reset import reset_password_ui
 from dotenv import load_dotenv
 import logging
+import log_config
+from log_config import error_text, mask_email
 
 # ─── SETUP LOGGING ───
-logging.basicConfig(level=logging.INFO)
+log_config.configure()
 logger = logging.getLogger(__name__)
 
 # ─── LOAD ENVIRONMENT VARIABLES ───
@@ -19,9 +30,36 @@ if not load_dotenv():
     logger.error("Failed to load .env file. Check file format and path.")
     st.error("⚠️ Failed to load environment variables. Please check your .env file.")
 
+# ─── TRANSCRIPT WINDOW ───
+# Messages rendered on each rerun; "Load older" reveals TRANSCRIPT_PAGE more.
+TRANSCRIPT_WINDOW = int(os.getenv("TRANSCRIPT_WINDOW", "40"))
+TRANSCRIPT_PAGE = int(os.getenv("TRANSCRIPT_PAGE", "40"))
+# Messages read from disk when a conversation is opened. The model sees at most
+# CONTEXT_TOKEN_BUDGET of recent history, so this only needs to cover that.
+HISTORY_TAIL = int(os.getenv("HISTORY_TAIL", "200"))
+# Conversations listed in the sidebar when not searching; older ones are found by search.
+RECENT_CHATS = int(os.getenv("RECENT_CHATS", "15"))
+# How often a reply being generated in the background is redrawn. Each redraw
+# resends the reply so far, so a longer interval sends fewer bytes but
+# updates less smoothly.
+GENERATION_POLL_SECONDS = float(os.getenv("GENERATION_POLL_MS", "250")) / 1000
+# Users who see the metrics page in the sidebar (comma-separated emails).
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
+
 # ─── SETUP ───
-init_db()
+@st.cache_resource
+def bootstrap_db():
+    # Runs once per process, not on every rerun; applies pending migrations.
+    init_db()
+    # Serves METRICS_PORT / writes METRICS_FILE when configured.
+    metrics.start_exporters()
+    # Delivers mail a previous process left in the outbox.
+    if otp_sender.API_KEY and otp_sender.SENDER_EMAIL:
+        otp_sender.start_sender()
+    return True
+
 st.set_page_config(page_title="JokeBot Pro", layout="centered", page_icon="🤖")
+bootstrap_db()
 
 # ─── CUSTOM CSS FOR RED, BLACK, AND WHITE THEME ───
 st.markdown(
@@ -116,74 +154,150 @@ if "user" not in st.session_state:
     st.session_state.user = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
+# Position of messages[0] in the conversation file; older messages stay on disk.
+if "messages_offset" not in st.session_state:
+    st.session_state.messages_offset = 0
+if "transcript_visible" not in st.session_state:
+    st.session_state.transcript_visible = TRANSCRIPT_WINDOW
 if "current_conversation_id" not in st.session_state:
     st.session_state.current_conversation_id = None
 if "conversations" not in st.session_state:
     st.session_state.conversations = []
 if "show_reset_password" not in st.session_state:
     st.session_state.show_reset_password = False
+if "search_page" not in st.session_state:
+    st.session_state.search_page = 0
+if "pending_job" not in st.session_state:
+    st.session_state.pending_job = None
 
 # ─── CREATE NEW CONVERSATION ───
 def create_new_conversation(email):
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     random_num = random.randint(1000, 9999)
     safe_id = f"chat_{timestamp}_{random_num}"
-    file_path = os.path.join(f"user_data/{email}_conversations", f"{safe_id}.json")
     st.session_state.current_conversation_id = safe_id
     st.session_state.messages = []
+    st.session_state.messages_offset = 0
+    st.session_state.transcript_visible = TRANSCRIPT_WINDOW
     # Create an empty conversation file to avoid FileNotFoundError
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "w") as f:
-        json.dump([], f)
-    st.session_state.conversations.append({
-        "title": f"Chat - {timestamp}",
-        "file": file_path,
-        "id": safe_id
-    })
-    logger.info(f"Created new conversation {safe_id} for user {email}")
+    entry = conversation_store.add_conversation(email, safe_id)
+    st.session_state.conversations.append(entry)
+    logger.info("Created new conversation %s for user %s", safe_id, mask_email(email))
     return safe_id
 
 # ─── LOAD OLD CONVERSATIONS ───
 def load_conversations(email):
-    conversation_dir = f"user_data/{email}_conversations"
-    files = []
-    try:
-        files = sorted([f for f in os.listdir(conversation_dir) if f.endswith(".json")], key=lambda x: x)
-    except FileNotFoundError:
-        logger.warning(f"Conversation directory {conversation_dir} not found")
-    conversations = []
-    for f in files:
-        file_path = os.path.join(conversation_dir, f)
-        conv_id = f.replace(".json", "")
-        try:
-            with open(file_path, "r") as file:
-                messages = json.load(file)
-                title = messages[0]["content"][:30] + "..." if messages else f"Chat - {conv_id.split('_')[1]}"
-        except (FileNotFoundError, json.JSONDecodeError, IndexError) as e:
-            logger.warning(f"Failed to load conversation {f}: {e}")
-            title = f"Chat - {conv_id.split('_')[1]}"
-        conversations.append({"title": title, "file": file_path, "id": conv_id})
+    # Reads only the per-user index; conversation files are parsed only when
+    # the index is missing or corrupt.
+    conversations = conversation_store.list_conversations(email)
     st.session_state.conversations = conversations
-    logger.info(f"Loaded {len(conversations)} conversations for user {email}")
+    logger.info("Loaded %s conversations for user %s", len(conversations), mask_email(email))
+    try:
+        # One-off per process: indexes conversations saved before search existed.
+        search_index.build_user_index(email)
+    except Exception as e:
+        logger.warning("Failed to build search index for user %s: %s", mask_email(email), e)
+
+# ─── BACKGROUND GENERATION ───
+def reconcile_pending_job():
+    """Return the in-flight generation job for this session, or None.
+
+    A finished job's reply is already on disk (the worker saved it), so the
+    transcript is re-read from the file rather than patched in memory; that
+    keeps the session and the file in step whatever order things finished in.
+    """
+    job_id = st.session_state.get("pending_job")
+    if not job_id:
+        return None
+    job = generation.get_job(job_id)
+    if job is None:
+        # Expired or from a previous process: the file is authoritative.
+        st.session_state.pending_job = None
+        reload_current_conversation()
+        return None
+    if not job.done:
+        return job
+    st.session_state.pending_job = None
+    if job.message:
+        logger.info("Assistant response saved (%d chars)", len(job.message["content"]))
+    else:
+        logger.warning("No response received from API")
+    if job.conversation_id == st.session_state.current_conversation_id:
+        reload_current_conversation()
+        if not job.message:
+            st.session_state.reply_failed = True
+    return None
+
+@st.fragment(run_every=GENERATION_POLL_SECONDS)
+def show_pending_reply(job_id):
+    """Draw a background reply from its buffer. Runs on a timer and returns
+    at once, so no script thread waits for the reply to finish."""
+    job = generation.get_job(job_id)
+    if job is None or job.done:
+        st.rerun()  # full rerun: reconcile_pending_job() loads the saved reply
+    text = job.snapshot()
+    with st.chat_message("assistant"):
+        st.markdown(text + " ▌" if text else "…")
+
+def reload_current_conversation():
+    current_file = next((c["file"] for c in st.session_state.conversations
+                        if c["id"] == st.session_state.current_conversation_id), None)
+    if not current_file:
+        return
+    try:
+        # Keep any older pages the user has already loaded.
+        count = max(HISTORY_TAIL, len(st.session_state.messages) + 1)
+        offset, messages = conversation_store.read_window(current_file, count)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logger.warning("Failed to reload conversation %s: %s", st.session_state.current_conversation_id, error_text(e))
+        return
+    st.session_state.messages_offset = offset
+    st.session_state.messages = messages
 
 # ─── SAVE CONVERSATION ───
 def save_current_conversation():
+    """Save the session transcript. Returns False if the file was ahead of the
+    session (another tab or a generation worker wrote to it); the transcript is
+    then reloaded from disk instead of overwriting those messages."""
+    reconcile_pending_job()
     if st.session_state.current_conversation_id and st.session_state.messages:
         current_file = next((c["file"] for c in st.session_state.conversations
                             if c["id"] == st.session_state.current_conversation_id), None)
         if current_file:
             try:
-                with open(current_file, "w") as f:
-                    json.dump(st.session_state.messages, f, indent=2)
-                first_message = st.session_state.messages[0]["content"][:30] + "..." if st.session_state.messages else f"Chat - {st.session_state.current_conversation_id.split('_')[1]}"
+                entry = conversation_store.save_conversation(
+                    st.session_state.user["email"],
+                    st.session_state.current_conversation_id,
+                    current_file,
+                    st.session_state.messages,
+                    offset=st.session_state.messages_offset,
+                )
                 for conv in st.session_state.conversations:
                     if conv["id"] == st.session_state.current_conversation_id:
-                        conv["title"] = first_message
+                        conv.update(entry)
                         break
-                logger.info(f"Saved conversation {st.session_state.current_conversation_id} to {current_file}")
             except Exception as e:
-                logger.error(f"Failed to save conversation {st.session_state.current_conversation_id}: {e}")
+                logger.error("Failed to save conversation %s: %s", st.session_state.current_conversation_id, error_text(e))
                 st.error("⚠️ Failed to save conversation. Please try again.")
+                return True
+            if entry["message_count"] > st.session_state.messages_offset + len(st.session_state.messages):
+                logger.info("Conversation %s changed on disk; reloading", st.session_state.current_conversation_id)
+                reload_current_conversation()
+                return False
+            logger.info("Saved conversation %s for user %s", st.session_state.current_conversation_id,
+                        mask_email(st.session_state.user["email"]))
+            try:
+                search_index.index_conversation(
+                    st.session_state.user["email"],
+                    st.session_state.current_conversation_id,
+                    current_file,
+                    st.session_state.messages,
+                    offset=st.session_state.messages_offset,
+                )
+            except Exception as e:
+                # The next save (or build_user_index) picks up what was missed.
+                logger.warning("Failed to index conversation %s: %s", st.session_state.current_conversation_id, error_text(e))
+    return True
 
 # ─── AUTH ───
 st.sidebar.title("🔐 JokeBot Login")
@@ -211,11 +325,18 @@ if not st.session_state.user:
             submitted = st.form_submit_button("Login")
 
             if submitted:
-                user = authenticate_user(email, password)
+                if not rate_limit.allow("login", email, st.session_state):
+                    st.error("🚦 Too many attempts. Please wait a moment and try again.")
+                    st.stop()
+                try:
+                    user = authenticate_user(email, password)
+                except HashingBusy:
+                    st.warning("⏳ Server is busy, please try again in a moment.")
+                    st.stop()
                 if user:
                     st.session_state.user = user
                     st.success("🎉 Login successful!")
-                    os.makedirs(f"user_data/{email}_conversations", exist_ok=True)
+                    os.makedirs(conversation_store.conversation_dir(email), exist_ok=True)
                     create_new_conversation(email)
                     load_conversations(email)
                     st.rerun()
@@ -231,22 +352,30 @@ if not st.session_state.user:
             email = st.text_input("📧 Email")
             password = st.text_input("🔑 Password", type="password")
             if st.form_submit_button("Sign Up"):
+                if not rate_limit.allow("signup", email, st.session_state):
+                    st.error("🚦 Too many attempts. Please wait a moment and try again.")
+                    st.stop()
                 try:
                     register_user(email, name, password)
                     st.session_state.user = {"email": email, "name": name}
                     st.success("🎉 Registered and logged in!")
-                    os.makedirs(f"user_data/{email}_conversations", exist_ok=True)
+                    os.makedirs(conversation_store.conversation_dir(email), exist_ok=True)
                     create_new_conversation(email)
                     load_conversations(email)
                     st.rerun()
-                except Exception:
+                except HashingBusy:
+                    st.warning("⏳ Server is busy, please try again in a moment.")
+                except sqlite3.IntegrityError:
                     st.error("⚠️ Email already exists.")
+                except Exception as e:
+                    logger.error("Registration failed for %s: %s", mask_email(email), e)
+                    st.error("⚠️ Registration failed. Please try again.")
     st.stop()
 
 # ─── SETUP USER FOLDERS ───
 email = st.session_state.user["email"]
 name = st.session_state.user["name"]
-conversation_dir = f"user_data/{email}_conversations"
+conversation_dir = conversation_store.conversation_dir(email)
 os.makedirs(conversation_dir, exist_ok=True)
 
 if not st.session_state.conversations:
@@ -259,14 +388,14 @@ col1, col2 = st.sidebar.columns([1, 1])
 with col1:
     if st.button("➕ New Chat"):
         save_current_conversation()
-        create_new_conversation(email)
-        load_conversations(email)  # Reload conversations to update sidebar
+        create_new_conversation(email)  # Updates the index and sidebar state in place
         st.rerun()
 
 with col2:
     if st.button("🚪 Logout"):
         save_current_conversation()
-        for k in ["user", "messages", "current_conversation_id", "conversations"]:
+        for k in ["user", "messages", "messages_offset", "transcript_visible", "current_conversation_id", "conversations",
+                  "search_page", "pending_job"]:
             st.session_state.pop(k, None)
         st.rerun()
 
@@ -277,27 +406,93 @@ if st.sidebar.button("🗑️ Delete All Chats"):
             os.remove(conv["file"])
         except FileNotFoundError:
             pass
+    conversation_store.clear_index(email)
+    search_index.remove_user(email)
     st.session_state.conversations = []
     st.session_state.messages = []
+    st.session_state.messages_offset = 0
     st.session_state.current_conversation_id = None
     st.success("🧹 All chats deleted.")
-    logger.info(f"Deleted all chats for user {email}")
+    logger.info("Deleted all chats for user %s", mask_email(email))
     st.rerun()
 
 # ─── CHAT HISTORY ───
+def open_conversation(conv):
+    save_current_conversation()
+    st.session_state.current_conversation_id = conv["id"]
+    st.session_state.transcript_visible = TRANSCRIPT_WINDOW
+    try:
+        # Only the tail is loaded; older messages are paged in by "Load older".
+        offset, messages = conversation_store.read_window(conv["file"], HISTORY_TAIL)
+        st.session_state.messages_offset = offset
+        st.session_state.messages = messages
+        logger.info("Loaded conversation %s (%d of %d messages)", conv['id'], len(messages), offset + len(messages))
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logger.warning("Failed to load conversation %s: %s", conv['id'], error_text(e))
+        st.session_state.messages = []
+        st.session_state.messages_offset = 0
+    # A reply still being generated for this chat (e.g. from before a reload) resumes streaming.
+    job = generation.active_job(email, conv["id"])
+    if job is not None:
+        st.session_state.pending_job = job.id
+    st.rerun()
+
+def reset_search_page():
+    st.session_state.search_page = 0
+
 st.sidebar.subheader("📜 Chat History")
-for conv in sorted(st.session_state.conversations, key=lambda x: x["id"], reverse=True):
-    if st.sidebar.button(conv["title"], key=f"chat_btn_{conv['id']}"):
-        save_current_conversation()
-        st.session_state.current_conversation_id = conv["id"]
-        try:
-            with open(conv["file"], "r") as f:
-                st.session_state.messages = json.load(f)
-            logger.info(f"Loaded conversation {conv['id']}")
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            logger.warning(f"Failed to load conversation {conv['id']}: {e}")
-            st.session_state.messages = []
-        st.rerun()
+search_query = st.sidebar.text_input("🔍 Search chats", key="search_query", on_change=reset_search_page)
+if search_query.strip():
+    try:
+        hits, has_more = search_index.search(email, search_query, st.session_state.search_page)
+    except Exception as e:
+        logger.warning("Search failed: %s", e)
+        hits, has_more = [], False
+    conversations_by_id = {c["id"]: c for c in st.session_state.conversations}
+    hits = [(hit, conversations_by_id[hit["id"]]) for hit in hits if hit["id"] in conversations_by_id]
+    if not hits and st.session_state.search_page == 0:
+        st.sidebar.caption("No matching chats.")
+    for hit, conv in hits:
+        if st.sidebar.button(conv["title"], key=f"search_btn_{conv['id']}"):
+            open_conversation(conv)
+        st.sidebar.caption(hit["snippet"])
+    prev_col, next_col = st.sidebar.columns([1, 1])
+    with prev_col:
+        if st.session_state.search_page > 0 and st.button("⬅️ Previous", key="search_prev"):
+            st.session_state.search_page -= 1
+            st.rerun()
+    with next_col:
+        if has_more and st.button("Next ➡️", key="search_next"):
+            st.session_state.search_page += 1
+            st.rerun()
+else:
+    recent = heapq.nlargest(RECENT_CHATS, st.session_state.conversations,
+                            key=lambda c: (c.get("updated", ""), c["id"]))
+    for conv in recent:
+        if st.sidebar.button(conv["title"], key=f"chat_btn_{conv['id']}"):
+            open_conversation(conv)
+    older = len(st.session_state.conversations) - len(recent)
+    if older > 0:
+        st.sidebar.caption(f"{older} older chats; use search to find them.")
+
+# ─── ADMIN METRICS ───
+if email.lower() in ADMIN_EMAILS:
+    with st.sidebar.expander("📈 Metrics"):
+        if not metrics.METRICS_ENABLED:
+            st.caption("Metrics are disabled (METRICS_ENABLED=0).")
+        else:
+            hash_stats = hashing.stats()
+            st.caption(f"Password hashing: {hash_stats['in_flight']} in flight, "
+                       f"{hash_stats['queue_depth']}/{hash_stats['queue_limit']} queued, "
+                       f"{hash_stats['rejected']} rejected, on {hash_stats['workers']} workers")
+            st.caption("Timings in ms; percentiles are estimated from histogram buckets.")
+            rows = metrics.summary_rows()
+            if rows:
+                st.dataframe(rows, hide_index=True)
+            else:
+                st.caption("Nothing recorded yet.")
+            st.download_button("⬇️ Prometheus text", metrics.render(), file_name="jokebot_metrics.prom",
+                               mime="text/plain")
 
 # ─── MAIN CHAT ───
 user = st.session_state.user
@@ -307,10 +502,38 @@ st.title(f"💬 Chat with JokeBot, {user['name']}")
 if not st.session_state.current_conversation_id:
     create_new_conversation(email)
 
-# Display messages
+def load_older_messages():
+    """Reveal another page of the transcript, reading it from disk if needed."""
+    st.session_state.transcript_visible += TRANSCRIPT_PAGE
+    missing = st.session_state.transcript_visible - len(st.session_state.messages)
+    offset = st.session_state.messages_offset
+    if missing <= 0 or offset == 0:
+        return
+    current_file = next((c["file"] for c in st.session_state.conversations
+                        if c["id"] == st.session_state.current_conversation_id), None)
+    if not current_file:
+        return
+    try:
+        start, older = conversation_store.read_window(current_file, max(missing, TRANSCRIPT_PAGE), offset)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logger.warning("Failed to page conversation %s: %s", st.session_state.current_conversation_id, error_text(e))
+        return
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.messages_offset = start
+
+# A reply the worker finished since the last run is loaded before drawing.
+pending_job = reconcile_pending_job()
+chat_busy = pending_job is not None and pending_job.conversation_id == st.session_state.current_conversation_id
+
+# Display messages: messages are kept in insertion order, and only the last
+# `transcript_visible` of them are rendered.
+visible = st.session_state.messages[-st.session_state.transcript_visible:]
+hidden = st.session_state.messages_offset + len(st.session_state.messages) - len(visible)
 chat_container = st.container()
 with chat_container:
-    for msg in sorted(st.session_state.messages, key=lambda x: x.get("timestamp", "")):
+    if hidden:
+        st.button(f"⬆️ Load older messages ({hidden} more)", key="load_older", on_click=load_older_messages)
+    for msg in visible:
         with st.chat_message(msg["role"]):
             st.markdown(msg["content"])
     # Auto-scroll to the bottom
@@ -325,49 +548,39 @@ with chat_container:
         """,
         unsafe_allow_html=True
     )
+    if st.session_state.pop("reply_failed", False):
+        st.warning("⚠️ Sorry, something went wrong. Please try again.")
 
-user_input = st.chat_input("Say something...", key="chatbox")
+user_input = st.chat_input("Say something...", key="chatbox", disabled=chat_busy)
 
-if user_input:
-    st.session_state.messages.append({
+if user_input and not chat_busy:
+    user_message = {
         "role": "user",
         "content": user_input,
         "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
+    }
+    st.session_state.messages.append(user_message)
+    # The user turn goes to disk first; the worker appends the reply after it.
+    if not save_current_conversation():
+        # This tab was behind the file and has been reloaded: add the turn on top.
+        st.session_state.messages.append(user_message)
+        save_current_conversation()
 
+    with log_config.request_context() as request_id:
+        agent = Agent(name="JokeBot", instructions=JOKEBOT_INSTRUCTIONS, router=ModelRouter.from_env())
+        pending_job = generation.submit(
+            agent, user_input, user['name'],
+            email=email,
+            conversation_id=st.session_state.current_conversation_id,
+            history=st.session_state.messages[:-1],
+            request_id=request_id,
+        )
+    st.session_state.pending_job = pending_job.id
+    st.rerun()  # redraw with the new turn in the transcript and the input disabled
+
+if chat_busy:
+    # Generation runs on a background worker; the fragment below only polls
+    # its buffer. A rerun or a returning session lands here again and picks
+    # up wherever the reply has got to.
     with chat_container:
-        with st.chat_message("user"):
-            st.markdown(user_input)
-
-        with st.chat_message("assistant"):
-            placeholder = st.empty()
-            agent = Agent(name="JokeBot", instructions="Be humorous")
-            runner = Runner.run_streamed(agent, user_input, user['name'])
-
-            response_holder = [""]  # Mutable container for response
-
-            async def stream_response():
-                try:
-                    async for event in runner.stream_events():
-                        content = ItemHelpers.text_message_output(event.item)
-                        response_holder[0] += content
-                        placeholder.markdown(response_holder[0])
-                except Exception as e:
-                    logger.error(f"Error streaming response: {e}")
-                    placeholder.markdown("⚠️ Sorry, something went wrong. Please try again.")
-
-            asyncio.run(stream_response())
-
-            if response_holder[0]:
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response_holder[0],
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-                logger.info(f"Appended assistant response for input: {user_input[:30]}...")
-            else:
-                logger.warning("No response received from API")
-
-    save_current_conversation()
-    load_conversations(email)  # Reload conversations to update sidebar
-    st.rerun()
\ No newline at end of file
+        show_pending_reply(pending_job.id)
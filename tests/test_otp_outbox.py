@@ -0,0 +1,117 @@
+# tests/test_otp_outbox.py
+"""The OTP outbox against benchmarks/fake_mailersend.py: retries, dedup, give-up and crash recovery."""
+import time
+
+import pytest
+
+import db
+import fake_mailersend
+import otp_sender
+
+
+@pytest.fixture
+def mail(tmp_path, monkeypatch):
+    """A fresh users.db and a fake MailerSend; yields a function that starts the server."""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "users.db"))
+    db.init_db()
+    monkeypatch.setattr(otp_sender, "API_KEY", "test")
+    monkeypatch.setattr(otp_sender, "SENDER_EMAIL", "jokebot@example.com")
+    monkeypatch.setattr(otp_sender, "OUTBOX_MODE", "single")
+    monkeypatch.setattr(otp_sender, "BACKOFF_BASE", 60)  # retries only happen after make_due()
+    monkeypatch.setattr(otp_sender, "start_sender", lambda: None)  # tests drain by hand
+    servers = []
+
+    def start(**kwargs):
+        server, base_url = fake_mailersend.start_server(**kwargs)
+        servers.append(server)
+        monkeypatch.setattr(otp_sender, "MAILER_SEND_URL", f"{base_url}/email")
+        monkeypatch.setattr(otp_sender, "MAILER_SEND_BULK_URL", f"{base_url}/bulk-email")
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+    db.get_pool().close()
+
+
+def make_due():
+    """Skip the backoff: every pending message is due now."""
+    db.execute("UPDATE email_outbox SET next_attempt_at = ? WHERE status = ?", (time.time(), otp_sender.PENDING))
+
+
+def test_message_is_sent_and_its_status_tracked_by_id(mail):
+    server = mail()
+    [msg_id] = otp_sender.send_otp_emails([("ann@example.com", "123456")])
+    assert otp_sender.outbox_status(msg_id) == otp_sender.PENDING
+    assert otp_sender.drain_once() == 1
+    assert otp_sender.outbox_status(msg_id) == otp_sender.SENT
+    assert [m["to"][0]["email"] for m in server.messages] == ["ann@example.com"]
+
+
+def test_pending_message_to_the_same_recipient_is_replaced_not_duplicated(mail):
+    server = mail()
+    first = otp_sender.enqueue_email("ann@example.com", "OTP", "Your OTP is: 111111")
+    second = otp_sender.enqueue_email("ann@example.com", "OTP", "Your OTP is: 222222")
+    assert first == second
+    otp_sender.drain_once()
+    assert [m["text"] for m in server.messages] == ["Your OTP is: 222222"]
+
+
+def test_server_errors_are_retried_with_backoff_until_sent(mail):
+    server = mail(script=[503, 502])
+    msg_id = otp_sender.enqueue_email("ann@example.com", "OTP", "body")
+    otp_sender.drain_once()
+    assert otp_sender.outbox_status(msg_id) == otp_sender.PENDING
+    make_due()
+    otp_sender.drain_once()
+    assert otp_sender.outbox_status(msg_id) == otp_sender.PENDING
+    make_due()
+    otp_sender.drain_once()
+    assert otp_sender.outbox_status(msg_id) == otp_sender.SENT
+    assert server.stats["requests"] == 3
+    assert len(server.messages) == 1
+
+
+def test_client_errors_fail_without_retrying(mail):
+    server = mail(script=[422])
+    msg_id = otp_sender.enqueue_email("ann@example.com", "OTP", "body")
+    otp_sender.drain_once()
+    make_due()
+    otp_sender.drain_once()
+    assert otp_sender.outbox_status(msg_id) == otp_sender.FAILED
+    assert server.stats["requests"] == 1
+
+
+def test_gives_up_after_max_attempts(mail, monkeypatch):
+    monkeypatch.setattr(otp_sender, "MAX_ATTEMPTS", 2)
+    server = mail(error_rate=1.0)
+    msg_id = otp_sender.enqueue_email("ann@example.com", "OTP", "body")
+    for _ in range(3):
+        otp_sender.drain_once()
+        make_due()
+    assert otp_sender.outbox_status(msg_id) == otp_sender.FAILED
+    assert server.stats["requests"] == 2
+
+
+def test_recover_stale_requeues_only_abandoned_claims(mail):
+    server = mail()
+    abandoned = otp_sender.enqueue_email("ann@example.com", "OTP", "body")
+    live = otp_sender.enqueue_email("bob@example.com", "OTP", "body")
+    otp_sender._claim_due()  # a sender claims both, then "crashes"
+    stale_at = time.time() - 3 * (otp_sender.CONNECT_TIMEOUT + otp_sender.READ_TIMEOUT)
+    db.execute("UPDATE email_outbox SET claimed_at = ? WHERE id = ?", (stale_at, abandoned))
+
+    assert otp_sender.recover_stale() == 1
+    assert otp_sender.outbox_status(abandoned) == otp_sender.PENDING
+    assert otp_sender.outbox_status(live) == otp_sender.SENDING
+    otp_sender.drain_once()
+    assert [m["to"][0]["email"] for m in server.messages] == ["ann@example.com"]
+
+
+def test_each_message_is_claimed_just_before_it_is_sent(mail):
+    mail(latency_ms=50)
+    ids = [otp_sender.enqueue_email(f"user{i}@example.com", "OTP", "body") for i in range(3)]
+    assert otp_sender.drain_once() == 3
+    claims = [db.query_one("SELECT claimed_at FROM email_outbox WHERE id = ?", (i,))[0] for i in ids]
+    # A batch claim would stamp them all at once; per-message claims follow the sends.
+    assert claims[1] - claims[0] >= 0.04
+    assert claims[2] - claims[1] >= 0.04
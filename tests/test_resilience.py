@@ -0,0 +1,174 @@
+# tests/test_resilience.py
+"""resilient_stream() against in-process upstreams: hedging, deadlines, retries and the breaker."""
+import asyncio
+import time
+
+import pytest
+from openai import AsyncOpenAI
+
+import fake_openai
+from resilience import CircuitBreaker, CircuitOpen, FirstTokenTimeout, Policy, TotalTimeout, resilient_stream
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def upstream(*attempts):
+    """open_stream() whose n-th call streams attempts[n]: a list of chunks,
+    ("sleep", seconds) steps, or exceptions to raise at that point."""
+    calls = []
+
+    async def open_stream():
+        script = attempts[min(len(calls), len(attempts) - 1)]
+        calls.append(script)
+
+        async def chunks():
+            for step in script:
+                if isinstance(step, BaseException):
+                    raise step
+                if isinstance(step, tuple):
+                    await asyncio.sleep(step[1])
+                else:
+                    yield step
+        return chunks()
+    return open_stream, calls
+
+
+def collect(open_stream, policy, circuit, received=None):
+    """Run the stream to the end; chunks land in `received` even if it raises."""
+    received = [] if received is None else received
+
+    async def run():
+        async for chunk in resilient_stream(open_stream, policy, circuit):
+            received.append(chunk)
+    asyncio.run(run())
+    return received
+
+
+def quick_policy(**overrides):
+    settings = {"first_token_timeout": 1, "total_timeout": 5, "max_retries": 0,
+                "retry_base_delay": 0, "retry_max_delay": 0, "hedge_after": 0}
+    settings.update(overrides)
+    return Policy(**settings)
+
+
+def test_streams_all_chunks_and_records_success():
+    open_stream, calls = upstream(["Why ", "so ", "serious?"])
+    circuit = CircuitBreaker(threshold=2)
+    assert collect(open_stream, quick_policy(), circuit) == ["Why ", "so ", "serious?"]
+    assert len(calls) == 1
+    assert circuit.state == CircuitBreaker.CLOSED
+
+
+def test_hedge_wins_when_first_attempt_is_slow():
+    open_stream, calls = upstream([("sleep", 2), "slow"], ["fast", "!"])
+    start = time.monotonic()
+    received = collect(open_stream, quick_policy(first_token_timeout=3, hedge_after=0.05), CircuitBreaker())
+    assert received == ["fast", "!"]
+    assert len(calls) == 2
+    assert time.monotonic() - start < 1
+
+
+def test_first_token_timeouts_are_retried_then_open_the_circuit():
+    open_stream, calls = upstream([("sleep", 5), "never"])
+    circuit = CircuitBreaker(threshold=2)
+    with pytest.raises(CircuitOpen):
+        collect(open_stream, quick_policy(first_token_timeout=0.05, max_retries=5), circuit)
+    assert len(calls) == 2
+    assert circuit.state == CircuitBreaker.OPEN
+
+
+def test_first_token_timeout_raised_once_retries_run_out():
+    open_stream, calls = upstream([("sleep", 5), "never"])
+    circuit = CircuitBreaker(threshold=10)
+    with pytest.raises(FirstTokenTimeout):
+        collect(open_stream, quick_policy(first_token_timeout=0.05, max_retries=2), circuit)
+    assert len(calls) == 3
+    assert circuit.failures == 3
+
+
+def test_total_timeout_mid_stream_keeps_what_was_sent_and_counts_a_failure():
+    open_stream, calls = upstream(["Knock knock. ", ("sleep", 5), "Who's there?"])
+    circuit = CircuitBreaker(threshold=5)
+    received = []
+    with pytest.raises(TotalTimeout):
+        collect(open_stream, quick_policy(total_timeout=0.2, max_retries=3), circuit, received)
+    assert received == ["Knock knock. "]
+    assert len(calls) == 1  # nothing is retried once a token is out
+    assert circuit.failures == 1
+
+
+def test_non_retryable_error_is_raised_without_touching_the_breaker():
+    open_stream, calls = upstream([ValueError("bad request")])
+    circuit = CircuitBreaker(threshold=1)
+    with pytest.raises(ValueError):
+        collect(open_stream, quick_policy(max_retries=3), circuit)
+    assert len(calls) == 1
+    assert circuit.state == CircuitBreaker.CLOSED
+    assert circuit.failures == 0
+
+
+def test_half_open_lets_one_trial_through_and_closes_on_success():
+    clock = FakeClock()
+    circuit = CircuitBreaker(threshold=1, reset_after=10, clock=clock)
+    circuit.record_failure()
+    assert not circuit.allow()
+
+    clock.now = 10
+    assert circuit.allow()        # the trial
+    assert not circuit.allow()    # everyone else still fails fast
+    circuit.release()             # trial abandoned without a verdict
+
+    open_stream, _ = upstream(["ok"])
+    assert collect(open_stream, quick_policy(), circuit) == ["ok"]
+    assert circuit.state == CircuitBreaker.CLOSED
+    assert circuit.allow()
+
+
+def test_failed_half_open_trial_reopens_the_circuit():
+    clock = FakeClock()
+    circuit = CircuitBreaker(threshold=3, reset_after=10, clock=clock)
+    for _ in range(3):
+        circuit.record_failure()
+    clock.now = 10
+    open_stream, calls = upstream([("sleep", 5), "never"])
+    with pytest.raises(CircuitOpen):
+        collect(open_stream, quick_policy(first_token_timeout=0.05, max_retries=3), circuit)
+    assert len(calls) == 1  # one trial, then fail fast
+    assert circuit.state == CircuitBreaker.OPEN
+    assert circuit.opened_at == 10
+
+
+def test_upstream_5xx_from_the_openai_client_is_retried_until_the_circuit_opens():
+    server, base_url = fake_openai.start_server(error_rate=1.0, error_status=503)
+
+    async def run():
+        client = AsyncOpenAI(api_key="test", base_url=base_url, max_retries=0)
+
+        async def open_stream():
+            stream = await client.chat.completions.create(
+                model="gpt-4o-mini", messages=[{"role": "user", "content": "hi"}], stream=True)
+
+            async def texts():
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            return texts()
+        try:
+            async for _ in resilient_stream(open_stream, quick_policy(max_retries=5), circuit):
+                pass
+        finally:
+            await client.close()
+
+    circuit = CircuitBreaker(threshold=2)
+    try:
+        with pytest.raises(CircuitOpen):
+            asyncio.run(run())
+    finally:
+        server.shutdown()
+    assert server.stats["requests"] == 2
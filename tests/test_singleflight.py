@@ -0,0 +1,128 @@
+# tests/test_singleflight.py
+"""SingleFlight: one upstream run per key, replayed to every subscriber."""
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def gated_source(chunks, calls, gate=None, error=None):
+    """Factory for an upstream that yields `chunks`, pausing before the last
+    one until `gate` is set, then optionally raising `error`."""
+    def factory():
+        calls.append(1)
+
+        async def run():
+            for i, chunk in enumerate(chunks):
+                if gate is not None and i == len(chunks) - 1:
+                    await gate.wait()
+                yield chunk
+            if error is not None:
+                raise error
+        return run()
+    return factory
+
+
+async def drain(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_concurrent_requests_share_one_upstream_run():
+    group = SingleFlight()
+    calls = []
+
+    async def run():
+        gate = asyncio.Event()
+        factory = gated_source(["a", "b", "c"], calls, gate)
+        readers = [asyncio.ensure_future(drain(group.stream("k", factory))) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        gate.set()
+        return await asyncio.gather(*readers)
+
+    assert asyncio.run(run()) == [["a", "b", "c"]] * 3
+    assert len(calls) == 1
+    assert group.stats() == {"leaders": 1, "followers": 2, "in_flight": 0}
+
+
+def test_late_subscriber_replays_the_buffered_chunks_then_follows():
+    group = SingleFlight()
+    calls = []
+
+    async def run():
+        gate = asyncio.Event()
+        factory = gated_source(["one ", "two ", "three"], calls, gate)
+        first = asyncio.ensure_future(drain(group.stream("k", factory)))
+        await asyncio.sleep(0.01)  # the leader has published everything but the last chunk
+        late = asyncio.ensure_future(drain(group.stream("k", factory)))
+        await asyncio.sleep(0.01)
+        gate.set()
+        return await first, await late
+
+    first, late = asyncio.run(run())
+    assert first == late == ["one ", "two ", "three"]
+    assert len(calls) == 1
+    assert group.followers == 1
+
+
+def test_upstream_error_reaches_every_subscriber_after_the_replay():
+    group = SingleFlight()
+    calls = []
+
+    async def run():
+        gate = asyncio.Event()
+        factory = gated_source(["partial"], calls, gate, error=RuntimeError("upstream died"))
+        received = [[], []]
+
+        async def read(into):
+            async for chunk in group.stream("k", factory):
+                into.append(chunk)
+        readers = [asyncio.ensure_future(read(into)) for into in received]
+        await asyncio.sleep(0.01)
+        gate.set()
+        results = await asyncio.gather(*readers, return_exceptions=True)
+        return received, results
+
+    received, results = asyncio.run(run())
+    assert received == [["partial"], ["partial"]]
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len(calls) == 1
+
+
+def test_finished_flight_is_not_reused():
+    group = SingleFlight()
+    calls = []
+
+    async def run():
+        factory = gated_source(["x"], calls)
+        return await drain(group.stream("k", factory)), await drain(group.stream("k", factory))
+
+    assert asyncio.run(run()) == (["x"], ["x"])
+    assert len(calls) == 2
+
+
+def test_leader_finishes_when_its_subscriber_goes_away():
+    group = SingleFlight()
+    calls = []
+    finished = []
+
+    def factory():
+        calls.append(1)
+
+        async def run():
+            for chunk in ("a", "b"):
+                await asyncio.sleep(0.01)
+                yield chunk
+            finished.append(True)  # e.g. the response cache gets filled here
+        return run()
+
+    async def run():
+        reader = asyncio.ensure_future(drain(group.stream("k", factory)))
+        await asyncio.sleep(0.005)
+        reader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await reader
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    assert finished == [True]